@@ -9,7 +9,6 @@ import pandas as pd
 # import numpy as np
 import s3fs
 import boto3
-import random
 
 import multiprocessing as mp
 import time
@@ -22,10 +21,18 @@ fs = s3fs.S3FileSystem(anon=False)
 s3 = boto3.resource('s3')
 
 DATA_BUCKET = 'orange-sthar'
+# Outputs are written here first and moved to their place when the run ends
+STAGING_DIR = '_staging'
 
 
 def dump_to_file(dest_bucket, dataframe, path, name, count, to_s3=False,
-                 final=False, yesterday=False):
+                 final=False, kind='output', metrics=None):
+    '''Writes the dataframe and returns the name of the file (None if empty).
+
+       kind is the start of the name of the file (output, yesterday...).'''
+    if metrics is None:
+        metrics = kido.Metrics()
+    final_path = None
     # We need to make sure output_path exists
     if not dataframe.empty:
         if args.output is not None:
@@ -36,95 +43,226 @@ def dump_to_file(dest_bucket, dataframe, path, name, count, to_s3=False,
             final_str = '_final'
         else:
             final_str = ''
-        if yesterday:
-            output_name = ('yesterday_%s_%s%s.csv.gz' % (name, output_count,
-                           final_str))
-        else:
-            output_name = ('output_%s_%s%s.csv.gz' % (name, output_count,
-                       final_str))
-        # We first dump to a csv so we can compress it.
+        extension = kido.output_extension(args.format, args.codec)
+        output_name = ('%s_%s_%s%s%s' % (kind, name, output_count, final_str,
+                                         extension))
+        # We first dump to a local file so we can compress it.
         final_path = os.path.join(output_path, output_name)
-        dataframe.to_csv(final_path, compression='gzip', index=False)
+        stats = {}
+        with metrics.timer('compress', rows=len(dataframe)) as counter:
+            final_path = kido.write_output(dataframe, final_path, args.format,
+                                           args.codec, args.level,
+                                           args.codec_threads, stats)
+            counter['bytes'] = stats['bytes']
+            counter['raw_bytes'] = stats['raw_bytes']
+        metrics.log('write', file=final_path, rows=len(dataframe), **stats)
         # "Directories" within the bucket get created automatically
         #if to_s3:
         #    kido.move_to_s3(final_path, dest_bucket, final_path)
-    return None
+    return final_path
 
 
-def process_data(dest_bucket, date_string_list, section_size, foreigners_only=False,
-                 region_cell_dataframe=None, create_epoch=False):
-    process_int = int(mp.current_process().name)
-    cdr_df = pd.DataFrame()
-    yesterday_cdr_df = pd.DataFrame()
-    # YYYYMMDD
-    year = int(date_string_list[0])
-    month = int(date_string_list[1])
-    day = int(date_string_list[2])
-    previous_day = datetime.date.fromordinal(datetime.date(year, month, day).toordinal() - 1).timetuple()[0:3]
-    yesterday = previous_day[0] * 10000 + previous_day[1] * 100 + previous_day[2]
-    # Make the output paths
-    output_path = os.path.join('CDRs', *date_string_list)
-    yesterday_output_path = os.path.join('CDRs', '{:4}'.format(previous_day[0]),
-                                         '{:02}'.format(previous_day[1]),
-                                         '{:02}'.format(previous_day[2]))
-    file_count = 0
-    output_count = 0
-    # We randomize section_size to avoid that all processes are writing at the
-    # same time
-    variability = .15
-    max_cut = int(section_size * variability)
-    min_cut = int(max_cut / 10)
-    random_cut = random.randint(min_cut, max_cut)
-
-    # Some sections should be bigger, some smaller to distribute the writes
-    if process_int % 2:
-        random_cut *= -1
-    section_size += random_cut
-
-    cells_in_zone = set()
-    for column in region_cell_df.loc[:, 'CID_1':]:
-        cells_in_zone = cells_in_zone | set(region_cell_df[column])
-    if {-1}.issubset(cells_in_zone):
-        cells_in_zone.remove(-1)
-
-    while not q.empty():
-        # We use this to limit the amount of memory used per process
-        # We should probably limit based on the size of the DataFrame per
-        # process with something like:
-        # cdr_df.shape[0] > 20000000 (20M ~= 1 GB file)
-        if file_count < section_size:
-            data = q.get()
+def share_frame(dataframe, shared_prefix):
+    '''Returns a handle to a copy of dataframe in shared memory.'''
+    return kido.share_batch(kido.frame_to_batch(dataframe), shared_prefix)
+
+
+def open_shared_frame(handle):
+    '''Returns the dataframe of a handle made by share_frame.'''
+    return kido.batch_to_frame(kido.open_shared_batch(handle))
+
+
+def read_data(worker, scheduler, read_q, foreigners_only=False,
+              shared_cells=None, create_epoch=False, shared_prefix='cdr',
+              metrics_options=None):
+    '''Reader stage: parses and filters the CDR files given by the scheduler.
+
+       With create_epoch orange.read_cdr_file adds the epoch, Date is kept
+       so the writers can split the CDRs by day. Only the CDRs of the cells
+       in shared_cells are kept (all of them if it is empty). The frames go
+       to the transform stage as handles to shared memory. metrics_options
+       are given to kido.Metrics.'''
+    if metrics_options is None:
+        metrics_options = {}
+    metrics = kido.Metrics('reader-%d' % worker, **metrics_options)
+    # Sorted array of the CID in the region, shared with the other processes
+    cells_in_zone = kido.CIDarray_from_shared(shared_cells)
+    for data in kido.iter_scheduled_files(scheduler, worker, metrics):
+        with metrics.timer('read') as counter:
+            # Without cells orange.read_cdr_file keeps every CDR, the region
+            # is filtered below on the whole column at once
             local_df = pd.DataFrame(orange.read_cdr_file(data, foreigners_only,
-                                    cells_in_zone, create_epoch))
-            # We saw events from two (!) days before in some files so we need
-            # to throw away anything older than yesterday
-            old_mask = local_df['Date'] < yesterday
-            local_df = local_df[~old_mask]
-            yesterday_mask = local_df['Date'] == yesterday
-            yesterday_cdr_df = yesterday_cdr_df.append(local_df[yesterday_mask])
-            cdr_df = cdr_df.append(local_df[~yesterday_mask])
-            file_count += 1
-        else:
-            dump_to_file(dest_bucket, cdr_df, output_path, process_int,
-                         output_count, True)
-            cdr_df = pd.DataFrame()
-            file_count = 0
-            output_count += 1
-    dump_to_file(dest_bucket, cdr_df, output_path, process_int, output_count,
-                 True, True)
-    dump_to_file(dest_bucket, yesterday_cdr_df, yesterday_output_path,
-                 process_int, 0, True, False, True)
+                                                         set(), create_epoch))
+            counter['rows'] = len(local_df)
+        if len(cells_in_zone):
+            with metrics.timer('filter', rows=len(local_df)) as counter:
+                local_df = local_df[kido.isInCIDarray(local_df['Start Cell'].values,
+                                                      cells_in_zone)]
+                counter['kept'] = len(local_df)
+        metrics.queue('read', read_q)
+        read_q.put((data, share_frame(local_df, shared_prefix)))
+    metrics.close()
     return None
 
 
+def split_data(worker, read_q, write_q, shared_prefix='cdr',
+               metrics_options=None):
+    '''Transform stage: splits the CDRs of each file by day.
+
+       All the days of a file go together to the same writer, as a dict of
+       day to the handle of its frame in shared memory.'''
+    if metrics_options is None:
+        metrics_options = {}
+    metrics = kido.Metrics('transform-%d' % worker, **metrics_options)
+    while True:
+        data = read_q.get()
+        if data is None:
+            break
+        key, handle = data
+        with metrics.timer('split', rows=handle['rows'],
+                           size=handle['bytes']) as counter:
+            parts = kido.split_by_day(open_shared_frame(handle))
+            handles = {day: share_frame(part, shared_prefix)
+                       for day, part in parts.items()}
+            counter['days'] = len(handles)
+        metrics.queue('write', write_q)
+        write_q.put((key, handles))
+    metrics.close()
+    return None
+
+
+def day_kind(day, today, yesterday):
+    '''Returns the start of the name of the files of day.
+
+       Events of today go to output files, and the ones from other days
+       found in the files of today to yesterday, late (older) or early
+       (newer) files. Events without a date go to undated files.'''
+    if day == kido.NO_DAY:
+        return 'undated'
+    elif day == today:
+        return 'output'
+    elif day == yesterday:
+        return 'yesterday'
+    elif day < yesterday:
+        return 'late'
+    return 'early'
+
+
+def day_path(day):
+    '''Returns the output path of a day given as YYYYMMDD.'''
+    if day == kido.NO_DAY:
+        return os.path.join('CDRs', 'undated')
+    return os.path.join('CDRs', '%04d' % (day // 10000),
+                        '%02d' % (day // 100 % 100), '%02d' % (day % 100))
+
+
+def write_data(dest_bucket, write_q, today, yesterday, section_size, max_rows,
+               max_buffered_rows, manifest_file, run_name, create_epoch=False,
+               metrics_options=None):
+    '''Writer stage: dumps every day when it has the data of section_size
+       files or max_rows rows (the days come split from split_data).
+
+       When all the days together have more than max_buffered_rows rows the
+       biggest one is dumped. The outputs are written to the directory of
+       the manifest in STAGING_DIR and recorded in the manifest. A file is
+       done once all its days are.'''
+    # The run is part of the name so a restart doesn't overwrite the files
+    # of the previous one
+    process_name = run_name + '-' + mp.current_process().name
+    if metrics_options is None:
+        metrics_options = {}
+    metrics = kido.Metrics('writer-' + mp.current_process().name,
+                           **metrics_options)
+    manifest = kido.open_manifest(manifest_file)
+    staging_dir = kido.manifest_staging_dir(STAGING_DIR, manifest_file)
+    output_count = {}
+    final = False
+
+    def dump_day(day, dataframe, keys, done_keys):
+        outputs = []
+        if day is not None:
+            if create_epoch:
+                dataframe = dataframe.drop('Date', axis=1)
+            count = output_count.get(day, 0)
+            output_count[day] = count + 1
+            staged = dump_to_file(dest_bucket, dataframe,
+                                  os.path.join(staging_dir, day_path(day)),
+                                  process_name, count, True, final,
+                                  day_kind(day, today, yesterday), metrics)
+            if staged is not None:
+                outputs.append((staged, os.path.relpath(staged, staging_dir)))
+        kido.record_outputs(manifest, keys, outputs, done_keys)
+        return None
+
+    router = kido.DayRouter(dump_day, max_rows, section_size,
+                            max_buffered_rows)
+    while True:
+        data = write_q.get()
+        if data is None:
+            break
+        key, handles = data
+        with metrics.timer('accumulate',
+                           rows=sum(handle['rows'] for handle in handles.values()),
+                           size=sum(handle['bytes'] for handle in handles.values())):
+            parts = {day: open_shared_frame(handle)
+                     for day, handle in handles.items()}
+        router.add_days(key, parts)
+    # Whatever is left when we are told to stop
+    final = True
+    router.flush()
+    manifest.close()
+    metrics.close()
+    return None
+
+
+def wait_for_stage(jobs, queues, metrics, interval=30):
+    '''Waits for all the processes of a stage, recording the queue depths.'''
+    for p in jobs:
+        p.join(interval)
+        while p.is_alive():
+            for name, queue in queues:
+                metrics.queue(name, queue)
+            metrics.emit()
+            p.join(interval)
+    return None
+
+
+def start_stage(name, workers, target, args, indexed=False):
+    '''Starts workers processes running target(*args).
+
+       If indexed, the number of the worker is given as first argument.'''
+    jobs = []
+    for i in range(workers):
+        if indexed:
+            worker_args = (i,) + args
+        else:
+            worker_args = args
+        p = mp.Process(name=name + str(i), target=target, args=worker_args)
+        jobs.append(p)
+        p.start()
+    return jobs
+
+
 if __name__ == '__main__':
 
     # Parse the input
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", "--np", default=4, type=int,
-                        help="Number of parallel processes to use")
+                        help="Number of parallel processes reading files")
+    parser.add_argument("-t", "--transformers", default=1, type=int,
+                        help="Number of processes splitting the data by day")
+    parser.add_argument("-w", "--writers", default=2, type=int,
+                        help="Number of processes writing the output")
+    parser.add_argument("-q", "--queue_size", default=100, type=int,
+                        help="Maximum number of files waiting between stages")
+    parser.add_argument("-b", "--batch_size", default=2 ** 26, type=int,
+                        help="Bytes of input files given to a reader at once")
     parser.add_argument("-s", "--section_size", default=500, type=int,
-                        help="Number of files to read before dumping to disk")
+                        help="Number of files to read before dumping a day to disk")
+    parser.add_argument("--max_rows", default=20000000, type=int,
+                        help="Number of rows of a day to accumulate before dumping to disk (20M ~= 1 GB file)")
+    parser.add_argument("--max_buffered_rows", default=40000000, type=int,
+                        help="Number of rows of all days a writer keeps before dumping the biggest day")
     parser.add_argument("-r", "--region_file", type=str,
                         help="Cell DataFrame for the region to work with for a first filtering")
     parser.add_argument("-f", "--foreigners", action='store_true',
@@ -133,6 +271,23 @@ if __name__ == '__main__':
                         help="Modify Date/Time to Epoch (deleting Date in the process).")
     parser.add_argument("-o", "--output", type=str,
                         help="Name of the directory files will be saved to.")
+    parser.add_argument("-m", "--manifest", type=str,
+                        help="SQLite file keeping track of the work done (default: manifest_YYYYMMDD.sqlite). A run that crashed only processes the missing files when started again.")
+    parser.add_argument("--format", default='csv',
+                        choices=sorted(kido.OUTPUT_FORMATS),
+                        help="Format of the output files (default: csv).")
+    parser.add_argument("--codec", choices=sorted(kido.CODECS),
+                        help="Compression of the output files (default: gzip for csv, snappy for parquet). pgzip is gzip made by several threads.")
+    parser.add_argument("--level", type=int,
+                        help="Compression level of the codec (default: kido.CODEC_LEVELS).")
+    parser.add_argument("--codec_threads", default=1, type=int,
+                        help="Threads used by the pgzip and zstd codecs.")
+    parser.add_argument("--metrics", type=str,
+                        help="JSON lines file for the metrics of every process (default: metrics_<run>.jsonl).")
+    parser.add_argument("--interval", default=30, type=float,
+                        help="Seconds between metrics written by a process.")
+    parser.add_argument("--profile", type=str,
+                        help="Directory to save a cProfile of every process to.")
     parser.add_argument("path", type=str,
                         help="Data to work with (should be s3 bucket)")
     args = parser.parse_args()
@@ -155,33 +310,92 @@ if __name__ == '__main__':
     else:
         region_cell_df = pd.DataFrame()
 
-    list_of_files = []
-    q = mp.Queue()
-    # Can we do this without recreating the processes?
+    # The CID of the region are computed once here and shared with all the
+    # processes (instead of sending them the whole cell DataFrame)
+    shared_cells = kido.share_CIDarray(kido.makeCIDarray(region_cell_df))
+
+    # Today and the day before as YYYYMMDD. Events of any other day are
+    # kept too, each day goes to its own directory
+    year, month, day = [int(value) for value in today]
+    previous_day = datetime.date.fromordinal(datetime.date(year, month, day).toordinal() - 1).timetuple()[0:3]
+    yesterday = previous_day[0] * 10000 + previous_day[1] * 100 + previous_day[2]
+    today_int = year * 10000 + month * 100 + day
+
+    # The manifest tells us what was already done by a previous run
+    if args.manifest is not None:
+        manifest_file = args.manifest
+    else:
+        manifest_file = 'manifest_%s.sqlite' % ''.join(today)
+    manifest = kido.open_manifest(manifest_file)
+    # Files written by a run that crashed before recording them. Each
+    # manifest stages its files in its own directory
+    kido.discard_unrecorded(manifest, kido.manifest_staging_dir(STAGING_DIR,
+                                                                manifest_file))
+    run_name = str(int(time.time()))
+    # Name of the frames this run leaves in shared memory
+    shared_prefix = 'process_cdr-' + run_name
+    if args.metrics is not None:
+        metrics_file = args.metrics
+    else:
+        metrics_file = 'metrics_%s.jsonl' % run_name
+    metrics_options = {'metrics_file': metrics_file,
+                       'interval': args.interval, 'profile_dir': args.profile}
+    metrics = kido.Metrics('main', metrics_file, args.interval)
+
+    # Bounded queues between stages: reading (CPU bound) and writing
+    # (compression and I/O) run at the same time, and a slow stage makes the
+    # one before it wait instead of filling the memory
+    read_q = mp.Queue(maxsize=args.queue_size)
+    write_q = mp.Queue(maxsize=args.queue_size)
+    queues = [('read', read_q), ('write', write_q)]
     print("Getting files from s3://%s" % os.path.join(SOURCE_BUCKET,
                                                       input_path))
-    time_start = time.time()
-    for cdr in CDR_LIST:
-        final_input_path = os.path.join(SOURCE_BUCKET, input_path, cdr)
-        list_of_files += fs.ls(final_input_path)
+    with metrics.timer('list') as counter:
+        for cdr in CDR_LIST:
+            final_input_path = os.path.join(SOURCE_BUCKET, input_path, cdr)
+            kido.register_inputs(manifest, kido.list_inputs(final_input_path))
+        list_of_files = kido.pending_inputs(manifest, sizes=True)
+        counter['rows'] = len(list_of_files)
+        counter['bytes'] = sum(size or 0 for file, size in list_of_files)
+    # Small files are grouped in batches of similar size and the readers
+    # steal batches from each other when they run out of work
+    batches = kido.make_batches(list_of_files, args.batch_size)
+    scheduler = kido.make_scheduler(batches, args.np)
+    reader_jobs = start_stage('reader', args.np, read_data,
+                              (scheduler, read_q, args.foreigners, shared_cells,
+                               args.epoch, shared_prefix, metrics_options),
+                              indexed=True)
+    transform_jobs = start_stage('transform', args.transformers, split_data,
+                                 (read_q, write_q, shared_prefix,
+                                  metrics_options),
+                                 indexed=True)
+    writer_jobs = start_stage('', args.writers, write_data,
+                              (DATA_BUCKET, write_q, today_int, yesterday,
+                               args.section_size, args.max_rows,
+                               args.max_buffered_rows, manifest_file,
+                               run_name, args.epoch, metrics_options))
 
-    print("List of files generated in %.1fs. It contains %d files." %
-          (time.time() - time_start, len(list_of_files)))
-    jobs = []
-    # We need a queue to make sure processes aren't doing the same stuff
-    for file in list_of_files:
-        q.put(file)
-    time_real_start = time.time()
-    for i in range(args.np):
-        p = mp.Process(name=str(i), target=process_data,
-                       args=(DATA_BUCKET, today, args.section_size,
-                             args.foreigners, region_cell_df, args.epoch))
-        jobs.append(p)
-        p.start()
+    # Each stage is told to stop once the one before it is done
+    wait_for_stage(reader_jobs, queues, metrics, args.interval)
+    for i in range(args.transformers):
+        read_q.put(None)
+    wait_for_stage(transform_jobs, queues, metrics, args.interval)
+    for i in range(args.writers):
+        write_q.put(None)
+    wait_for_stage(writer_jobs, queues, metrics, args.interval)
+    # Only left if a process died before reading its frames
+    kido.remove_shared_batches(shared_prefix)
 
-    for p in jobs:
-        p.join()
+    # Only when every file is done the outputs get their final names
+    published = kido.publish_outputs(manifest)
+    if published is None:
+        print("Some files were not processed, run again to finish them.")
+    else:
+        print("Published %d files." % published)
+    manifest.close()
 
-    print('Total time: ' + str(time.time() - time_start))
+    metrics.close()
+    kido.summarize_metrics(metrics_file)
+    print('Total time: %.1fs' % (time.time() - metrics.time_start))
     print('Exiting Main Process')
     sys.exit()
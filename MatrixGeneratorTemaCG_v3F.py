@@ -1,7 +1,7 @@
 print('>> Loading libraries...')
 
 from pandas    import read_csv,concat,DataFrame
-from numpy     import array
+from numpy     import array,zeros,repeat,add
 from itertools import product
 
 from io import StringIO
@@ -131,22 +131,35 @@ print(len(daat),daat.W.sum())
 
 daat=daat[['W','OD_zonas']]
 
+# OD_zonas is a list of [origin, destination, trips] per row. We parse all of
+# them at once into flat arrays instead of calling eval row by row
+odz=daat.OD_zonas.str.replace('[','',regex=False).str.replace(']','',regex=False).str.replace(' ','',regex=False)
+nvalues=odz.str.count(',')+(odz.str.len()>0)
+odvalues=array(','.join(odz[nvalues>0]).split(','),dtype=float).reshape(-1,3) if nvalues.sum() else zeros((0,3))
+odorigin=odvalues[:,0].astype(int)
+oddestination=odvalues[:,1].astype(int)
+odtrips=odvalues[:,2]
+if (odtrips==odtrips.round()).all():
+    odtrips=odtrips.astype(int)
+odweight=repeat(daat.W.values,nvalues.values//3)
+
+# Dense matrices indexed by the position of the zone in zonas
+nzonas=len(zonas)
+denseOD=zeros((nzonas,nzonas),dtype=odtrips.dtype)
+add.at(denseOD,(odorigin,oddestination),odtrips)
+denseODW=zeros((nzonas,nzonas))
+add.at(denseODW,(odorigin,oddestination),odtrips*odweight/factor)
+
 allcombinatons=array(list(product(zonas[0],zonas[0]))).T
 matrixOD=DataFrame({'origin' :allcombinatons[0],
                            'destination':allcombinatons[1],
-                           'matrix_element':[0 for x in range(len(allcombinatons[0]))]})
+                           'matrix_element':denseOD.ravel()})
 matrixOD.set_index(['origin', 'destination'], inplace=True)
 matrixODW=DataFrame({'origin' :allcombinatons[0],
                            'destination':allcombinatons[1],
-                           'matrix_element':[0 for x in range(len(allcombinatons[0]))]})
+                           'matrix_element':denseODW.ravel()})
 matrixODW.set_index(['origin', 'destination'], inplace=True)
 
-for ODZ,WW in zip(daat.OD_zonas,daat.W):
-    lista=eval(ODZ)
-    for odw in lista:
-        matrixODW.loc[zonas.loc[odw[0],0],zonas.loc[odw[1],0]] += odw[2]*WW/factor
-        matrixOD.loc[zonas.loc[odw[0],0],zonas.loc[odw[1],0]]  += odw[2]
-		
 filename=indata.NombreFiltro[1].strip()
 
 matrixOD.to_csv('matrices/'+filename+'_matrixOD.csv', sep=',', encoding='utf-8')
@@ -154,17 +167,16 @@ print('matrixOD   sum:',matrixOD.sum().sum())
 matrixODW.to_csv('matrices/'+filename+'_matrixOD_scaled.csv', sep=',', encoding='utf-8')
 print('matrixOD_S sum:',matrixODW.sum().sum())
 
-def gra(row,line):
-    vv=(row.T).rename(index={'matrix_element': line})
-    vv.index.names = ['']
-    vv.columns.names = ['']
+# The dense matrices already have the origin x destination shape we need
+def gra(dense):
+    vv=DataFrame(dense,index=zonas[0].values,columns=zonas[0].values)
+    vv.index.name = ''
+    vv.columns.name = ''
     return vv
 
-mm=concat([ gra(matrixOD.loc[(ll,)],ll) for ll in zonas[0] ])
+mm=gra(denseOD)
 mm.to_csv('matrices/'+filename+'matrixOD_MM.csv', sep=',', encoding='utf-8')
 print('MM   sum:      ',mm.sum().sum())
-mmW=concat([ gra(matrixODW.loc[(ll,)],ll) for ll in zonas[0] ])
+mmW=gra(denseODW)
 mmW.to_csv('matrices/'+filename+'matrixOD_MM_Scaled.csv', sep=',', encoding='utf-8')
 print('MM_S sum:      ',mmW.sum().sum())
-
-
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+''' A script to benchmark our main entry points with synthetic data.
+
+    Data of several sizes is made with synthetic_data.py and every entry
+    point is run on it in its own process, recording the time, throughput
+    and peak memory. Results can be saved and compared with a previous run
+    to catch regressions before deploying.'''
+
+import argparse
+import os
+import sys
+import time
+import shutil
+import resource
+import subprocess
+import tempfile
+import multiprocessing as mp
+
+import pandas as pd
+
+import kido
+import extract_cells
+import synthetic_data
+
+OD_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'MatrixGeneratorTemaCG_v3F.py')
+
+
+def peak_memory(who=resource.RUSAGE_SELF):
+    """Returns the peak memory (RSS) of this process (or its children) in MB."""
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux gives KB, macOS bytes
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024.
+
+
+def bench_read_csv(dataset, workers):
+    """kido.readAllCSVInPath over all the CDR parts."""
+    def run():
+        return len(kido.readAllCSVInPath(dataset['cdr_path'], workers=workers))
+    return run, sum(os.path.getsize(file) for file in dataset['cdr_files'])
+
+
+def bench_make_zone_df(dataset, workers):
+    """kido.make_zone_df for half of the regions."""
+    cell_df = pd.read_csv(dataset['cell_file'], compression='gzip')
+    regions = [str(region) for region in range(1, 10)]
+
+    def run():
+        return len(kido.make_zone_df(cell_df, [regions], ['Region_Code']))
+    return run, cell_df.memory_usage(deep=True).sum()
+
+
+def bench_extract_cell_df(dataset, workers):
+    """extract_cells.extract_cell_df for the whole directory."""
+    cell_df = pd.read_csv(dataset['cell_file'], compression='gzip')
+
+    def run():
+        return len(extract_cells.extract_cell_df(cell_df)[1])
+    return run, cell_df.memory_usage(deep=True).sum()
+
+
+def bench_makeCIDLatLon(dataset, workers):
+    """kido.makeCIDLatLon for the whole directory."""
+    cell_df = pd.read_csv(dataset['cell_file'], compression='gzip')
+
+    def run():
+        return len(kido.makeCIDLatLon(cell_df))
+    return run, cell_df.memory_usage(deep=True).sum()
+
+
+def bench_cdr_extract(dataset, workers):
+    """The path of the data in cdr_extract, processor to writer.
+
+       orange.read_cdr_file is not in this repository, so the parts are
+       read with kido.read_csv_file. Every part goes through shared memory
+       and the writer joins them and writes the output."""
+    output_path = tempfile.mkdtemp(prefix='benchmark-')
+
+    def run():
+        prefix = 'benchmark-%d' % os.getpid()
+        handles = [kido.share_batch(kido.frame_to_batch(
+                   kido.read_csv_file(file)), prefix)
+                   for file in dataset['cdr_files']]
+        df_list = [kido.batch_to_frame(kido.open_shared_batch(handle))
+                   for handle in handles]
+        output_df = kido.concat_frames(df_list)
+        output_file = kido.write_output(output_df,
+                                        os.path.join(output_path, 'output'))
+        os.remove(output_file)
+        os.rmdir(output_path)
+        return len(output_df)
+    return run, sum(os.path.getsize(file) for file in dataset['cdr_files'])
+
+
+def bench_od_matrix(dataset, workers):
+    """MatrixGeneratorTemaCG_v3F.py for an average day.
+
+       It needs the encrypted OD files, so simplecrypt must be installed."""
+    od_path = dataset['od_path']
+    days = 3
+    files = [file for file in dataset['od_files'] if file.endswith('.enc')]
+    if not files:
+        return None, 0
+
+    def run():
+        subprocess.check_call([sys.executable, OD_SCRIPT], cwd=od_path,
+                              stdout=subprocess.DEVNULL)
+        return dataset['od_rows'] * days
+    return run, sum(os.path.getsize(file) for file in files[1:days + 1])
+
+
+BENCHMARKS = [('readAllCSVInPath', bench_read_csv),
+              ('make_zone_df', bench_make_zone_df),
+              ('extract_cell_df', bench_extract_cell_df),
+              ('makeCIDLatLon', bench_makeCIDLatLon),
+              ('cdr_extract', bench_cdr_extract),
+              ('od_matrix', bench_od_matrix)]
+
+
+def run_benchmark(benchmark, dataset, workers, result_q):
+    '''Runs one benchmark and puts its result in result_q.
+
+       Runs in its own process, so the peak memory is only its own (or
+       the one of the scripts it starts).'''
+    run, input_bytes = benchmark(dataset, workers)
+    if run is None:
+        result_q.put(None)
+        return None
+    memory_start = peak_memory()
+    time_start = time.time()
+    rows = run()
+    seconds = time.time() - time_start
+    result_q.put({'rows': rows, 'seconds': seconds,
+                  'input_mb': input_bytes / 1024. ** 2,
+                  'peak_mb': max(peak_memory() - memory_start,
+                                 peak_memory(resource.RUSAGE_CHILDREN))})
+    return None
+
+
+def run_benchmarks(dataset, names, workers=1, repeat=1):
+    """Returns a list of results (dicts) of the benchmarks in names.
+
+       The best time of repeat runs is kept."""
+    results = []
+    for name, benchmark in BENCHMARKS:
+        if name not in names:
+            continue
+        best = None
+        for i in range(repeat):
+            result_q = mp.Queue()
+            p = mp.Process(target=run_benchmark,
+                           args=(benchmark, dataset, workers, result_q))
+            p.start()
+            result = result_q.get()
+            p.join()
+            if result is None:
+                print("Skipping %s, its input data is missing." % name)
+                break
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        if best is None:
+            continue
+        best.update({'benchmark': name, 'size': dataset['rows'],
+                     'rows_per_second': best['rows'] / max(best['seconds'], 1e-9),
+                     'mb_per_second': best['input_mb'] / max(best['seconds'], 1e-9)})
+        print("%-18s %10d rows %8.2fs %12.0f rows/s %8.1f MB/s %8.1f MB peak" %
+              (name, best['rows'], best['seconds'], best['rows_per_second'],
+               best['mb_per_second'], best['peak_mb']))
+        results.append(best)
+    return results
+
+
+def compare_results(results_df, baseline_file, tolerance=0.2):
+    """Prints the benchmarks that got slower (or use more memory) than in
+       the baseline by more than tolerance. Returns the number of them."""
+    baseline_df = pd.read_csv(baseline_file)
+    merged = results_df.merge(baseline_df, on=['benchmark', 'size'],
+                              suffixes=('', '_baseline'))
+    slower = merged['seconds'] > merged['seconds_baseline'] * (1 + tolerance)
+    bigger = merged['peak_mb'] > merged['peak_mb_baseline'] * (1 + tolerance)
+    regressions = merged[slower | bigger]
+    for row in regressions.itertuples():
+        print("REGRESSION %s (%d): %.2fs (was %.2fs), %.1f MB (was %.1f MB)" %
+              (row.benchmark, row.size, row.seconds, row.seconds_baseline,
+               row.peak_mb, row.peak_mb_baseline))
+    return len(regressions)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", default='100000,1000000', type=str,
+                        help="Comma separated list of numbers of CDRs to test with")
+    parser.add_argument("-p", "--parts", default=8, type=int,
+                        help="Number of files the CDRs are split in")
+    parser.add_argument("-b", "--benchmarks", type=str,
+                        help="Comma separated list of benchmarks to run (default: all): %s" %
+                        ', '.join(name for name, benchmark in BENCHMARKS))
+    parser.add_argument("-w", "--workers", default=4, type=int,
+                        help="Number of threads reading files")
+    parser.add_argument("-r", "--repeat", default=1, type=int,
+                        help="Number of runs of each benchmark (the best is kept)")
+    parser.add_argument("-d", "--data", type=str,
+                        help="Directory to keep the synthetic data in (default: a temporary one, removed at the end)")
+    parser.add_argument("-o", "--output", type=str,
+                        help="CSV file to save the results to")
+    parser.add_argument("-c", "--compare", type=str,
+                        help="CSV file of a previous run to compare with")
+    parser.add_argument("-t", "--tolerance", default=0.2, type=float,
+                        help="Slowdown allowed when comparing (default: 0.2 = 20%%)")
+    parser.add_argument("--seed", default=0, type=int, help="Random seed")
+    args = parser.parse_args()
+
+    if args.benchmarks is not None:
+        names = args.benchmarks.split(',')
+    else:
+        names = [name for name, benchmark in BENCHMARKS]
+    if args.data is not None:
+        data_path = args.data
+    else:
+        data_path = tempfile.mkdtemp(prefix='benchmark-')
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        dataset_path = os.path.join(data_path, 'size_%d' % size)
+        time_start = time.time()
+        dataset = synthetic_data.make_dataset(dataset_path, size, args.parts,
+                                              seed=args.seed)
+        print("\nData for %d CDRs made in %.1fs" % (size, time.time() - time_start))
+        results += run_benchmarks(dataset, names, args.workers, args.repeat)
+
+    results_df = pd.DataFrame(results, columns=['benchmark', 'size', 'rows',
+                                                'seconds', 'rows_per_second',
+                                                'input_mb', 'mb_per_second',
+                                                'peak_mb'])
+    if args.data is None:
+        shutil.rmtree(data_path)
+    if args.output is not None:
+        results_df.to_csv(args.output, index=False)
+    if args.compare is not None and compare_results(results_df, args.compare,
+                                                    args.tolerance):
+        sys.exit(1)
+
+    sys.exit()
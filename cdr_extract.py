@@ -2,6 +2,7 @@
 
 import argparse
 import os
+import shutil
 import sys
 import time
 
@@ -14,6 +15,7 @@ import random
 import s3fs
 import boto3
 
+import kido
 import orange
 
 fs = s3fs.S3FileSystem(anon=False)
@@ -21,62 +23,130 @@ fs = s3fs.S3FileSystem(anon=False)
 s3 = boto3.resource('s3')
 
 DATA_BUCKET = 'orange-sthar'
+# Outputs are uploaded here first and moved to their place when the run ends
+STAGING_DIR = '_staging'
 
-def dump_to_s3(dest_bucket, dataframe, name, path, count, final=False):
+def dump_to_s3(dest_bucket, dataframe, name, path, count, final=False,
+               output_format='csv', metrics=None, codec_options=None):
+    '''codec_options (codec, level, codec_threads) are given to kido.write_output'''
+    if metrics is None:
+        metrics = kido.Metrics()
+    if codec_options is None:
+        codec_options = {}
     # We need to make sure output_path exists
     output_path = orange.make_safe_dir(path)
     if final:
         final_str='_final'
     else:
         final_str=''
-    output_name = ('output_%s_%s%s.csv.gz' % (name, count, final_str))
-    # We first dump to a csv so we can compress it.
-    dataframe.to_csv(os.path.join(output_path, output_name), compression='gzip', index=False)
+    output_name = ('output_%s_%s%s%s' % (name, count, final_str,
+                                         kido.output_extension(output_format,
+                                                               codec_options.get('codec'))))
+    # The CDRs of a section can be from several days, parquet gets a
+    # directory for each one
+    if output_format == 'parquet':
+        codec_options = dict(codec_options, partition_cols=kido.PARTITION_COLUMNS)
+    # We first dump to a local file so we can compress it.
+    stats = {}
+    with metrics.timer('compress', rows=len(dataframe)) as counter:
+        kido.write_output(dataframe, os.path.join(output_path, output_name), output_format,
+                          stats=stats, **codec_options)
+        counter['bytes'] = stats['bytes']
+        counter['raw_bytes'] = stats['raw_bytes']
+    metrics.log('write', file=output_name, rows=len(dataframe), **stats)
     # "Directories" within the bucket get created automatically
-    s3.meta.client.upload_file(os.path.join(output_path, output_name), dest_bucket, os.path.join(output_path, output_name))
-    os.remove(os.path.join(output_path, output_name))
+    with metrics.timer('upload', rows=len(dataframe), size=counter['bytes']):
+        if os.path.isdir(os.path.join(output_path, output_name)):
+            for root, dirs, files in os.walk(os.path.join(output_path, output_name)):
+                for file in files:
+                    s3.meta.client.upload_file(os.path.join(root, file), dest_bucket, os.path.join(root, file))
+            shutil.rmtree(os.path.join(output_path, output_name))
+        else:
+            s3.meta.client.upload_file(os.path.join(output_path, output_name), dest_bucket, os.path.join(output_path, output_name))
+            os.remove(os.path.join(output_path, output_name))
+    return 's3://' + os.path.join(dest_bucket, output_path, output_name)
+
+def dump_section(dest_bucket, manifest, keys, df_list, name, path, count,
+                 final=False, output_format='csv', metrics=None, codec_options=None,
+                 staging_dir=STAGING_DIR):
+    '''Uploads the data of the files in keys to staging_dir and records it in the manifest'''
+    staged = dump_to_s3(dest_bucket, kido.concat_frames(df_list), name,
+                        os.path.join(staging_dir, path), count, final,
+                        output_format, metrics, codec_options)
+    final_name = 's3://' + os.path.join(dest_bucket, path, os.path.basename(staged))
+    kido.record_outputs(manifest, keys, [(staged, final_name)])
     return None
 
-def write_data(dest_bucket, output_path, section_size):
-    '''Gets information from queue and writes it to a file'''
-    process_int = mp.current_process().name
-    file_count = 0
+def write_data(dest_bucket, output_path, section_size, max_rows, max_bytes,
+               manifest_file, run_name, output_format='csv', metrics_file=None,
+               interval=30, profile_dir=None, codec_options=None):
+    '''Gets information from queue and writes it to a file
+
+       A file is written when section_size batches, max_rows rows or
+       max_bytes bytes have been accumulated, whatever comes first.'''
+    # The run is part of the name so a restart doesn't overwrite the files
+    # of the previous one
+    process_int = run_name + '-' + mp.current_process().name
+    metrics = kido.Metrics('writer-' + mp.current_process().name, metrics_file,
+                           interval, profile_dir)
+    manifest = kido.open_manifest(manifest_file)
+    staging_dir = kido.manifest_staging_dir(STAGING_DIR, manifest_file)
     output_count = 0
-    cdr_df = pd.DataFrame()
+    keys = []
+    df_list = []
+    rows = 0
+    size = 0
     while True:
         data = write_q.get()
-        if type(data) == pd.core.frame.DataFrame:
-            if file_count < section_size:
-                cdr_df = cdr_df.append(data)
-                file_count += 1
-                if not (file_count % 50):
-                   print("The writer %s is accumulating: %d" % (process_int, file_count))
-                   print("Size of queue is: %d" % write_q.qsize())
-            else:
-                print("The writer is writing file: %d" % output_count)
-                dump_to_s3(dest_bucket, cdr_df, process_int, output_path, output_count)
-                cdr_df = pd.DataFrame()
-                file_count = 0
-                output_count += 1
-                print("Size of queue is: %d" % write_q.qsize())
-        else:
+        if data is None:
             break
+        key, handle = data
+        metrics.queue('write', write_q)
+        with metrics.timer('accumulate', rows=handle['rows'], size=handle['bytes']):
+            batch = kido.open_shared_batch(handle)
+            keys.append(key)
+            df_list.append(kido.batch_to_frame(batch))
+            rows += kido.batch_rows(batch)
+            size += kido.batch_bytes(batch)
+        if len(df_list) >= section_size or rows >= max_rows or size >= max_bytes:
+            dump_section(dest_bucket, manifest, keys, df_list, process_int,
+                         output_path, output_count, output_format=output_format,
+                         metrics=metrics, codec_options=codec_options,
+                         staging_dir=staging_dir)
+            keys = []
+            df_list = []
+            rows = 0
+            size = 0
+            output_count += 1
 
-    if not cdr_df.empty:
-        dump_to_s3(dest_bucket, cdr_df, output_path, output_count, True) 
+    # Whatever is left when we are told to stop
+    if df_list:
+        dump_section(dest_bucket, manifest, keys, df_list, process_int,
+                     output_path, output_count, True, output_format, metrics,
+                     codec_options, staging_dir)
+    manifest.close()
+    metrics.close()
     return None
 
-def process_data():
-    '''Reads the data from the original CSV files and processes it into a useable format'''
-    process_int = int(mp.current_process().name)
-    cdr_df = pd.DataFrame()
-    file_count = 0
-    output_count = 0
-    
-    while not file_q.empty():
-        data = file_q.get()
-        write_q.put(orange.read_cdr_file(data))
+def process_data(worker, scheduler, shared_prefix, metrics_file=None,
+                 interval=30, profile_dir=None):
+    '''Reads the data from the original CSV files and processes it into a useable format
 
+       The data goes to the writers through shared memory, only a small
+       handle is sent through write_q.'''
+    metrics = kido.Metrics('processor-%d' % worker, metrics_file, interval,
+                           profile_dir)
+    for data in kido.iter_scheduled_files(scheduler, worker, metrics):
+        with metrics.timer('read') as counter:
+            local_df = pd.DataFrame(orange.read_cdr_file(data))
+            counter['rows'] = len(local_df)
+        with metrics.timer('share', rows=len(local_df)) as counter:
+            batch = kido.frame_to_batch(local_df)
+            handle = kido.share_batch(batch, shared_prefix)
+            counter['bytes'] = handle['bytes']
+        metrics.queue('write', write_q)
+        write_q.put((data, handle))
+    metrics.close()
     return None
 
 if __name__ == '__main__':
@@ -86,6 +156,28 @@ if __name__ == '__main__':
     parser.add_argument("np", default=4, type=int, help="Number of parallel processes to use")
     parser.add_argument("path", type=str, help="Data to work with (should be s3 bucket)")
     parser.add_argument("section_size", default=2000, type=int, help="Number of files to read before dumping to disk")
+    parser.add_argument("--batch_size", default=2 ** 26, type=int,
+                        help="Bytes of input files given to a processor at once")
+    parser.add_argument("--max_rows", default=20000000, type=int,
+                        help="Number of rows to accumulate before dumping to disk (20M ~= 1 GB file)")
+    parser.add_argument("--max_bytes", default=2 ** 30, type=int,
+                        help="Bytes in memory to accumulate before dumping to disk")
+    parser.add_argument("-m", "--manifest", type=str,
+                        help="SQLite file keeping track of the work done (default: manifest_YYYYMMDD.sqlite)")
+    parser.add_argument("--format", default='csv', choices=sorted(kido.OUTPUT_FORMATS),
+                        help="Format of the output files (default: csv)")
+    parser.add_argument("--codec", choices=sorted(kido.CODECS),
+                        help="Compression of the output files (default: gzip for csv, snappy for parquet). pgzip is gzip made by several threads")
+    parser.add_argument("--level", type=int,
+                        help="Compression level of the codec (default: kido.CODEC_LEVELS)")
+    parser.add_argument("--codec_threads", default=1, type=int,
+                        help="Threads used by the pgzip and zstd codecs")
+    parser.add_argument("--metrics", type=str,
+                        help="JSON lines file for the metrics of every process (default: metrics_<run>.jsonl)")
+    parser.add_argument("--interval", default=30, type=float,
+                        help="Seconds between metrics written by a process")
+    parser.add_argument("--profile", type=str,
+                        help="Directory to save a cProfile of every process to")
     args = parser.parse_args()
 
     # Paths to work with
@@ -102,49 +194,91 @@ if __name__ == '__main__':
     # A smaller section_size means each individual file is smaller, so we don't risk filling /home
     section_size = args.section_size
 
-    list_of_files = []
-
-    time_main = time.time()
+    # The manifest tells us what was already done by a previous run, so a
+    # run that crashed only processes the missing files when started again
+    if args.manifest is not None:
+        manifest_file = args.manifest
+    else:
+        manifest_file = 'manifest_%s%s%s.sqlite' % (YEAR, MONTH, DAY)
+    manifest = kido.open_manifest(manifest_file)
+    # Files uploaded by a run that crashed before recording them. Each
+    # manifest stages its files in its own directory
+    staging_dir = kido.manifest_staging_dir(STAGING_DIR, manifest_file)
+    kido.discard_unrecorded(manifest, 's3://' + os.path.join(DATA_BUCKET, staging_dir))
+    run_name = str(int(time.time()))
+    # Name of the batches this run leaves in shared memory
+    shared_prefix = 'cdr_extract-' + run_name
+    if args.metrics is not None:
+        metrics_file = args.metrics
+    else:
+        metrics_file = 'metrics_%s.jsonl' % run_name
+    metrics = kido.Metrics('main', metrics_file, args.interval)
+    codec_options = {'codec': args.codec, 'level': args.level,
+                     'codec_threads': args.codec_threads}
 
-    # A queue for all the inputs and a queue for the writer processes
-    file_q = mp.Queue()
     # The limiting step is the writing, so we don't need write_q to be too big
     write_q = mp.Queue(maxsize=500)
 
-    time_start = time.time()
-    for cdr in CDR_TYPE:
-        final_input_path = os.path.join(SOURCE_BUCKET, input_path, cdr)
-        list_of_files += fs.ls(final_input_path)
-
-    print("List of files generated in %.1fs. Now the fun starts." % (time.time() - time_start))
+    with metrics.timer('list') as counter:
+        for cdr in CDR_TYPE:
+            final_input_path = os.path.join(SOURCE_BUCKET, input_path, cdr)
+            kido.register_inputs(manifest, kido.list_inputs(final_input_path))
+        list_of_files = kido.pending_inputs(manifest, sizes=True)
+        counter['rows'] = len(list_of_files)
+        counter['bytes'] = sum(size or 0 for file, size in list_of_files)
     writer_jobs = []
     processor_jobs = []
-    # We need a queue to make sure processes aren't doing the same stuff
-    for file in list_of_files:
-        file_q.put(file)
+    # Small files are grouped in batches of similar size and the processors
+    # steal batches from each other when they run out of work
+    write_processes = args.np - 1
+    batches = kido.make_batches(list_of_files, args.batch_size)
+    scheduler = kido.make_scheduler(batches, args.np - write_processes)
 
     # Create the write processes (we need around 80% of writer processes)
-    write_processes = args.np - 1
     for i in range(0, write_processes):
-        writer_p = mp.Process(name=str(i), target=write_data, args=(DATA_BUCKET, output_path, section_size))
+        writer_p = mp.Process(name=str(i), target=write_data, args=(DATA_BUCKET, output_path, section_size,
+                                                                    args.max_rows, args.max_bytes, manifest_file,
+                                                                    run_name, args.format, metrics_file,
+                                                                    args.interval, args.profile, codec_options))
         writer_jobs.append(writer_p)
         writer_p.start()
 
 
     # We already used one process for the writer
     for i in range(write_processes, args.np):
-        p = mp.Process(name=str(i), target=process_data)
+        p = mp.Process(name=str(i), target=process_data,
+                       args=(i - write_processes, scheduler, shared_prefix,
+                             metrics_file, args.interval, args.profile))
         processor_jobs.append(p)
         p.start()
     
+    # The depth of write_q tells whether the writers keep up
     for p in processor_jobs:
-        p.join()
+        p.join(args.interval)
+        while p.is_alive():
+            metrics.queue('write', write_q)
+            metrics.emit()
+            p.join(args.interval)
 
-    write_q.put('kill_writer')
+    # One None per writer, they write what they have left when they get it
+    for writer in writer_jobs:
+        write_q.put(None)
 
     for writer in writer_jobs:
-        writer_p.join()
-    
-    print('Total time: %.1fs' % (time.time() - time_main))
+        writer.join()
+    # Only left if a writer died before reading its batches
+    kido.remove_shared_batches(shared_prefix)
+
+    # Only when every file is done the outputs get their final names
+    published = kido.publish_outputs(manifest)
+    if published is None:
+        print("Some files were not processed, run again to finish them.")
+    else:
+        print("Published %d files." % published)
+    manifest.close()
+
+    metrics.close()
+    kido.summarize_metrics(metrics_file)
+    print('Total time: %.1fs' % (time.time() - metrics.time_start))
     print("Exiting Main Process")
     sys.exit()
@@ -67,14 +67,53 @@ def make_zone_df(cell_dataframe, zone_data, column_data, full):
     if full:
         zone_df = cell_dataframe
     else:
+        # One pass per column to find the rows of every zone, then a single
+        # selection (instead of one scan and one append per zone)
+        positions = []
+        no_rows = np.array([], dtype=np.int64)
         for i in range(len(zone_data)):
-            zone_list = zone_data[i]
-            for zone in zone_list:
-                local_df = extract_zone(cell_dataframe, column_data[i], int(zone))
-                zone_df = zone_df.append(local_df)
+            zone_index = cell_dataframe.groupby(column_data[i]).indices
+            positions += [zone_index.get(int(zone), no_rows)
+                          for zone in zone_data[i]]
+        if positions:
+            zone_df = cell_dataframe.iloc[np.concatenate(positions)]
     return zone_df
 
 
+def add_lac_to_cid(cell_dataframe, lac, keep_zero=False):
+    """Return the front columns and the CID columns with lac added.
+
+       Empty CID (negative, or 0 unless keep_zero) are set to -1. The
+       columns after Longitude which are not CID are dropped."""
+    front = cell_dataframe.loc[:, :'Longitude']
+    column_mask = cell_dataframe.columns.str.contains('CID')
+    cid_columns = cell_dataframe.columns[column_mask]
+    lac = np.asarray(lac)[:, np.newaxis]
+    updated_cid = cell_dataframe[cid_columns].values + lac
+    if keep_zero:
+        valid_mask = updated_cid >= lac
+    else:
+        valid_mask = updated_cid > lac
+    zone_cid = pd.DataFrame(np.where(valid_mask, updated_cid, -1).astype(int),
+                            index=cell_dataframe.index, columns=cid_columns)
+    return pd.concat([front, zone_cid], axis=1)
+
+
+def lte_lac(cell_codes, ccaa_codes, offset_codes):
+    """Return the LAC of LTE cells from their Cell_Code.
+
+       The LAC is made with the region (CCAA), the X/Y/Z offset and the
+       site number in the code."""
+    cell_codes = cell_codes.astype(str)
+    ccaa = cell_codes.str[:3].map(ccaa_codes)
+    offset = cell_codes.str[3].map(offset_codes)
+    unknown = ccaa.isnull() | offset.isnull()
+    if unknown.any():
+        raise KeyError("Unknown Cell_Code: %s" % cell_codes[unknown].iloc[0])
+    site = cell_codes.str[4:8].astype(int)
+    return (ccaa.astype(int) * 50000 + offset.astype(int) * 10000 + site) * 1000
+
+
 def extract_cell_df(cell_dataframe, municipalities=None, regions=None):
     """Return cell dataframe with only a subset of the antennas.
 
@@ -90,10 +129,11 @@ def extract_cell_df(cell_dataframe, municipalities=None, regions=None):
         sys.exit(1)
     else:
         # Remove the CID_X *columns* which are empty
-        zone_df = zone_df.reindex(columns=list(zone_df.columns[zone_df.apply(np.max) != -1]))
+        column_max = zone_df.select_dtypes(include=[np.number]).max()
+        zone_df = zone_df.drop(columns=column_max.index[column_max == -1])
 
         # Delete rows with empty CID to avoid wasted computations
-        zone_df.drop(zone_df.index[zone_df.loc[:, 'CID_1':].apply(max, axis=1) < 0], inplace=True)
+        zone_df = zone_df[~(zone_df.loc[:, 'CID_1':].max(axis=1).values < 0)]
         zone_df.reset_index(drop=True, inplace=True)
 
         # GSM and UMTS use the LAC+CID strings concatenated. LTE uses something
@@ -104,20 +144,8 @@ def extract_cell_df(cell_dataframe, municipalities=None, regions=None):
         # Keep just the 2G and 3G stuff
         zone_df = zone_df[~lte_mask].copy()
 
-        # Make a front section to concatenate after each operation on the CID sections
-        front = zone_df.loc[:, :'Longitude']
-
         # Make "sum" of LAC and CID for easier comparison with CDR_DF
-        column_mask = zone_df.columns.str.contains('CID')
-        updated_cid = zone_df.loc[:, zone_df.columns[column_mask]].add(zone_df.LAC * 100000, axis=0)
-        zone_df = pd.concat([front, updated_cid], axis=1)
-        # Maybe there's a smarter way to do it, but for now I concatenate the first part
-        # of an unchanged zone with the updated_cid from above
-
-        # Mask of CID to reset to -1
-        reset_mask = (zone_df.loc[:, column_mask].T > zone_df.LAC * 100000).T
-        zone_cid = zone_df.loc[:, column_mask][reset_mask].apply(pd.to_numeric).fillna(-1).astype(int)
-        zone_df = pd.concat([front, zone_cid], axis=1)
+        zone_df = add_lac_to_cid(zone_df, zone_df.LAC.values * 100000)
 
         # Now we do the 4G stuff
         ccaa_codes = {'MAD': 0, 'CAT': 1, 'AND': 2, 'ARA': 3, 'AST': 4,
@@ -128,20 +156,13 @@ def extract_cell_df(cell_dataframe, municipalities=None, regions=None):
         offset_codes = {'X': 0, 'Y': 1, 'Z': 2}
 
         # We modify directly the LAC to then concatenate both dataframes
-        lte_zone_df['LAC'] = lte_zone_df.apply(lambda row: ccaa_codes[row['Cell_Code'][:3]] * 50000, axis=1)
-        lte_zone_df['LAC'] += lte_zone_df.apply(lambda row: offset_codes[row['Cell_Code'][3]] * 10000, axis=1)
-        lte_zone_df['LAC'] += lte_zone_df.apply(lambda row: int(row['Cell_Code'][4:8]), axis=1)
-        lte_zone_df['LAC'] *= 1000
-        # We recycle some variables
-        front = lte_zone_df.loc[:, :'Longitude']
-        column_mask = lte_zone_df.columns.str.contains('CID')
-        updated_cid = lte_zone_df.loc[:, lte_zone_df.columns[column_mask]].add(lte_zone_df.LAC, axis=0)
-        lte_zone_df = pd.concat([front, updated_cid], axis=1)
-        reset_mask = (lte_zone_df.loc[:, column_mask].T >= lte_zone_df.LAC).T
-        zone_cid = lte_zone_df.loc[:, column_mask][reset_mask].apply(pd.to_numeric).fillna(-1).astype(int)
-        lte_zone_df = pd.concat([front, zone_cid], axis=1)
-
-        zone_df = zone_df.append(lte_zone_df)
+        lte_zone_df['LAC'] = lte_lac(lte_zone_df['Cell_Code'], ccaa_codes,
+                                     offset_codes)
+        # For LTE a CID of 0 is valid
+        lte_zone_df = add_lac_to_cid(lte_zone_df, lte_zone_df.LAC.values,
+                                     keep_zero=True)
+
+        zone_df = pd.concat([zone_df, lte_zone_df])
 
     return [name_string, zone_df]
 
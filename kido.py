@@ -1,17 +1,38 @@
 import os
+import sys
+import json
+import mmap
+import gzip
+import time
+import hashlib
 import random
 import string
+import sqlite3
+import cProfile
+import resource
+import contextlib
 import tempfile
 import datetime
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 # import geopandas as gpd
 from shapely.geometry import Point
 
 import s3fs
 import boto3
+from boto3.s3.transfer import TransferConfig
 
-fs = s3fs.S3FileSystem(anon=False)
-s3 = boto3.resource('s3')
+# To work against a local s3 stand-in (eg: moto_server or minio) set
+# S3_ENDPOINT_URL to its address
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+if S3_ENDPOINT_URL:
+    fs = s3fs.S3FileSystem(anon=False,
+                           client_kwargs={'endpoint_url': S3_ENDPOINT_URL})
+else:
+    fs = s3fs.S3FileSystem(anon=False)
+s3 = boto3.resource('s3', endpoint_url=S3_ENDPOINT_URL)
 
 # Static data
 DIR_AGES = 's3://orange-sthar/DATA/Edades2011/'
@@ -21,6 +42,8 @@ DIR_PROV = 's3://orange-sthar/DATA/PROV/'
 DIR_ROADS = 's3://orange-sthar/DATA/ROADS/'
 MCC_FILE = '/data01/DATA/MCC_Continent.csv.gz'
 DIR_HOLIDAYS = '/data01/DATA/holidays'
+# Local storage for results that are expensive to compute
+CACHE_DIR = os.path.join(os.getenv('HOME', '/tmp'), '.cache', 'kido')
 
 # Export lists
 # Used for standardizing output creation
@@ -29,6 +52,49 @@ COLUMNS_TO_SAVE = ['TimeEpoch', 'Start Cell', 'Latitude', 'Longitude']
 # kido.columns_to_save += ['Country', 'Continent']
 # dataframe_to_csv[kido.columns_to_save].to_csv(output_name, ...)
 
+# Types of the columns of our CDR frames (see apply_schema). Integer types
+# are only used if the values fit, float32 only if it keeps the precision
+# Cell ids are LAC * 100000 + CID for GSM cells, too big for 32 bits
+CDR_SCHEMA = {'Date': np.uint32, 'Time': np.uint32, 'TimeEpoch': np.uint32,
+              'Start Cell': np.int64, 'Cell ID': np.int64,
+              'Latitude': np.float32, 'Longitude': np.float32,
+              'Year': np.uint16, 'Month': np.uint8, 'Day': np.uint8,
+              'Hour': np.uint8, 'Country': 'category',
+              'Continent': 'category'}
+# Largest difference allowed when going to float32 (~1 m in degrees)
+FLOAT32_TOLERANCE = 1e-5
+# Other text columns become categories below this ratio of unique values
+CATEGORY_RATIO = 0.5
+
+# Output formats the writers understand and the extension of their files
+OUTPUT_FORMATS = {'csv': '.csv.gz', 'parquet': '.parquet'}
+# Codecs the CSV writers can use and the extension of their files. pgzip is
+# gzip made of blocks compressed in parallel, any gzip reader can read it.
+# zstd and lz4 need the zstandard and lz4 modules
+CODECS = {'gzip': '.gz', 'pgzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4',
+          'none': ''}
+# Levels used if none is given (9 is the one pandas uses for gzip)
+CODEC_LEVELS = {'gzip': 9, 'pgzip': 6, 'zstd': 3, 'lz4': 0, 'none': 0}
+# Rows turned into CSV at once, and size of the blocks of pgzip
+CSV_CHUNK_ROWS = 100000
+PGZIP_BLOCK_SIZE = 4 * 1024 ** 2
+# Columns used to partition parquet datasets of CDRs
+PARTITION_COLUMNS = ['Year', 'Month', 'Day']
+# Day given by split_by_day to the rows without a date
+NO_DAY = 0
+
+# Batches shared between processes are kept here (in memory if possible)
+if os.path.isdir('/dev/shm'):
+    SHARED_DIR = '/dev/shm'
+else:
+    SHARED_DIR = tempfile.gettempdir()
+
+# Uploads to s3 are sent in parts of S3_PART_SIZE bytes (s3 needs at least
+# 5 MB, except for the last one), S3_UPLOAD_THREADS at the same time
+S3_PART_SIZE = 64 * 1024 ** 2
+S3_UPLOAD_THREADS = 4
+S3_RETRIES = 3
+
 #
 #
 # Our functions
@@ -38,58 +104,420 @@ COLUMNS_TO_SAVE = ['TimeEpoch', 'Start Cell', 'Latitude', 'Longitude']
 # These aren't necessarily used in every project
 # but are general enough that are not specific to a company
 
-def readAllinDir(path):
-    local_path = path.split('/')
-    dataframe = pd.DataFrame()
-    if local_path[0] == 's3:':
-        dir_list = fs.ls(path)
-        for file in dir_list:
-            local_df = pd.read_csv(fs.open(file), low_memory=False)
-            dataframe = dataframe.append(local_df)
+def is_s3_path(path):
+    """Returns True if the path points to a s3 bucket."""
+    return str(path).startswith('s3://')
+
+
+def list_path_files(input_path):
+    """Returns the list of files referenced by a path.
+
+       The path can be local or in s3 and can be a directory or a file.
+       Files in s3 keep the 's3://' prefix so they can be told apart from
+       local ones."""
+    # In case we have a final /
+    input_path = input_path.rstrip('/')
+    if is_s3_path(input_path):
+        final_path = input_path[len('s3://'):]
+        if fs.isdir(final_path):
+            file_list = ['s3://' + file for file in sorted(fs.ls(final_path))]
+        else:
+            file_list = [input_path]
+    else:
+        if os.path.isdir(input_path):
+            file_list = [os.path.join(input_path, file)
+                         for file in sorted(os.listdir(input_path))]
+        else:
+            file_list = [input_path]
+    return file_list
+
+
+def open_file(file):
+    """Returns something pandas can read from, for local or s3 files."""
+    if is_s3_path(file):
+        return fs.open(file)
+    return file
+
+
+def open_compressed(file, compression='gzip'):
+    """Returns something pandas can read from and the compression to give
+       pandas, for local or s3 files.
+
+       Besides the compressions pandas knows, it reads the zstd and lz4
+       CODECS (also with 'infer', by the extension of the file)."""
+    if compression == 'infer':
+        for codec in ['zstd', 'lz4']:
+            if str(file).endswith(CODECS[codec]):
+                compression = codec
+    if compression not in ['zstd', 'lz4']:
+        return open_file(file), compression
+    if is_s3_path(file):
+        handle = fs.open(file)
+    else:
+        handle = open(file, 'rb')
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(handle), None
+    import lz4.frame
+    return lz4.frame.open(handle, 'rb'), None
+
+
+def downcast_column(column, column_type, fixed=False):
+    """Returns the column with column_type, or unchanged if it doesn't fit.
+
+       With fixed, an integer column with missing values gets the nullable
+       version of column_type (eg: UInt32) and a column that doesn't fit
+       raises ValueError."""
+    if column_type == 'category':
+        return column.astype('category')
+    column_type = np.dtype(column_type)
+    # The nullable version of the type (eg: UInt8) is kept as it is
+    if (column.dtype == column_type or
+            getattr(column.dtype, 'numpy_dtype', None) == column_type):
+        return column
+    values = column.values
+    missing = False
+    if column.dtype.kind not in 'iuf':
+        fits = False
+    elif column_type.kind in 'iu':
+        limits = np.iinfo(column_type)
+        missing = column.isnull().any()
+        values = values[~np.isnan(values)] if missing else values
+        fits = not ((values != np.round(values)).any() or
+                    (len(values) and (values.min() < limits.min or
+                                      values.max() > limits.max)))
+        if missing and not fixed:
+            fits = False
+    elif column_type == np.float32:
+        fits = not (np.abs(values.astype(np.float32) - values) >
+                    FLOAT32_TOLERANCE).any()
+    else:
+        fits = True
+    if fits and missing:
+        # uint32 -> UInt32, int64 -> Int64
+        return column.astype(column_type.name.replace('uint', 'UInt')
+                             .replace('int', 'Int'))
+    if fits:
+        return column.astype(column_type)
+    if fixed:
+        raise ValueError("Column %s (%s) doesn't fit in %s" %
+                         (column.name, column.dtype, column_type))
+    return column
+
+
+def apply_schema(dataframe, schema=CDR_SCHEMA, verbose=False, fixed=False):
+    """Returns a copy of the dataframe with the smaller column types of schema.
+
+       Text columns not in the schema with few distinct values become
+       categories. With fixed, the types don't depend on the data: the
+       columns of schema always get its type (nullable if there are missing
+       values, ValueError if they don't fit) and other text columns are
+       left as they are. That is what
+       pieces of the same data read one by one need (see iter_csv_chunks).
+       If verbose, prints how much memory was saved."""
+    memory_before = dataframe.memory_usage(deep=True).sum()
+    # Only the columns are replaced, the data is not copied
+    dataframe = dataframe.copy(deep=False)
+    for column in dataframe.columns:
+        if column in schema:
+            dataframe[column] = downcast_column(dataframe[column],
+                                                schema[column], fixed)
+        elif (not fixed and pd.api.types.is_string_dtype(dataframe[column]) and
+              dataframe[column].dtype.name != 'category' and len(dataframe) and
+              dataframe[column].nunique() < CATEGORY_RATIO * len(dataframe)):
+            dataframe[column] = dataframe[column].astype('category')
+    if verbose:
+        memory_after = dataframe.memory_usage(deep=True).sum()
+        print("Downcast saved %.1f MB (%.1f MB -> %.1f MB)" %
+              ((memory_before - memory_after) / 2 ** 20,
+               memory_before / 2 ** 20, memory_after / 2 ** 20))
+    return dataframe
+
+
+def read_csv_file(file, columns_to_keep=None, compression='gzip', schema=None,
+                  fixed_schema=False, **kwargs):
+    """Returns a DataFrame from a gzip CSV file (local or in s3).
+
+       Other compressions can be given, see open_compressed.
+       columns_to_keep is given to the parser so the other columns are never
+       parsed. The columns are returned in the order they were asked for.
+       If schema is given (eg: CDR_SCHEMA), it is applied to the result
+       (with fixed_schema, the same types for any file, see apply_schema)."""
+    handle, compression = open_compressed(file, compression)
+    local_df = pd.read_csv(handle, compression=compression,
+                           low_memory=False, usecols=columns_to_keep, **kwargs)
+    if columns_to_keep is not None:
+        local_df = local_df[columns_to_keep]
+    if schema is not None:
+        local_df = apply_schema(local_df, schema, fixed=fixed_schema)
+    return local_df
+
+
+def concat_frames(df_list, ignore_index=False):
+    """Returns a single DataFrame built in one go from a list of them.
+
+       Category columns keep their type when the frames have different
+       categories (pandas would turn them into object columns)."""
+    if not df_list:
+        return pd.DataFrame()
+    categories = {}
+    for dataframe in df_list:
+        for column in dataframe.columns:
+            if dataframe[column].dtype.name == 'category':
+                categories.setdefault(column, []).append(
+                    dataframe[column].cat.categories)
+    for column, indexes in categories.items():
+        if (len(indexes) < len(df_list) or
+                all(index.equals(indexes[0]) for index in indexes)):
+            continue
+        all_categories = indexes[0].append(indexes[1:]).unique()
+        df_list = [dataframe.assign(**{column: dataframe[column].cat
+                                       .set_categories(all_categories)})
+                   for dataframe in df_list]
+    return pd.concat(df_list, copy=False, ignore_index=ignore_index)
+
+
+def frame_to_batch(dataframe):
+    """Returns a batch (dict of column name to NumPy array) of a DataFrame.
+
+       Batches are cheaper to send between processes than DataFrames."""
+    return {column: dataframe[column].values for column in dataframe.columns}
+
+
+def batch_to_frame(batch):
+    """Returns the DataFrame of a batch made by frame_to_batch.
+
+       The arrays of the batch are used as they are, without a copy."""
+    return pd.DataFrame(batch, columns=list(batch), copy=False)
+
+
+def batch_rows(batch):
+    """Returns the number of rows in a batch."""
+    for array in batch.values():
+        return len(array)
+    return 0
+
+
+def array_bytes(array):
+    """Returns the memory used by an array, with the strings it points to."""
+    if isinstance(array, np.ndarray) and not array.dtype.hasobject:
+        return array.nbytes
+    # nbytes of an object array is only the size of the pointers
+    return int(pd.Series(array, copy=False).memory_usage(deep=True,
+                                                         index=False))
+
+
+def batch_bytes(batch):
+    """Returns the memory used by the arrays of a batch, strings included."""
+    return sum(array_bytes(array) for array in batch.values())
+
+
+def share_batch(batch, prefix='kido'):
+    """Puts the arrays of a batch in shared memory and returns a handle.
+
+       The handle is small, so it is cheap to send through a queue instead
+       of the batch. The numeric columns go to a file in SHARED_DIR (one per
+       batch), the others (strings, categories) travel in the handle. The
+       batch is rebuilt with open_shared_batch, once."""
+    descriptor, path = tempfile.mkstemp(prefix=prefix + '-', dir=SHARED_DIR)
+    columns = []
+    objects = {}
+    offset = 0
+    with os.fdopen(descriptor, 'wb') as output:
+        for column, array in batch.items():
+            if not isinstance(array, np.ndarray) or array.dtype.hasobject:
+                objects[column] = array
+                columns.append((column, None, 0, 0))
+                continue
+            array = np.ascontiguousarray(array)
+            # Arrays start at multiples of 8 bytes so they are aligned
+            padding = -offset % 8
+            output.write(b'\0' * padding)
+            offset += padding
+            output.write(array.tobytes())
+            columns.append((column, array.dtype.str, offset, len(array)))
+            offset += array.nbytes
+    return {'path': path, 'columns': columns, 'objects': objects,
+            'rows': batch_rows(batch), 'bytes': offset}
+
+
+def open_shared_batch(handle):
+    """Returns the batch of a handle made by share_batch, without copying it.
+
+       The arrays are mapped from shared memory. The file is removed right
+       away, so the memory is freed as soon as the arrays are not used
+       anymore. Arrays can be modified, but the changes are not shared."""
+    data = None
+    if handle['bytes']:
+        with open(handle['path'], 'rb') as shared:
+            data = mmap.mmap(shared.fileno(), 0, access=mmap.ACCESS_COPY)
+    os.remove(handle['path'])
+    batch = {}
+    for column, dtype, offset, rows in handle['columns']:
+        if dtype is None:
+            batch[column] = handle['objects'][column]
+        elif rows:
+            batch[column] = np.frombuffer(data, dtype, rows, offset)
+        else:
+            batch[column] = np.empty(0, dtype)
+    return batch
+
+
+def remove_shared_batches(prefix='kido'):
+    """Removes the shared batches of prefix that were never opened.
+
+       Returns the number of batches removed."""
+    removed = 0
+    for name in os.listdir(SHARED_DIR):
+        if name.startswith(prefix + '-'):
+            os.remove(os.path.join(SHARED_DIR, name))
+            removed += 1
+    return removed
+
+
+def read_with_retries(reader, file, retries=0, retry_wait=1, **kwargs):
+    """Returns the output of reader(file) and a dict with its timing.
+
+       Failed reads are tried again up to retries times, waiting a bit
+       longer each time. The last error is raised if all of them fail."""
+    attempt = 0
+    time_start = time.time()
+    while True:
+        try:
+            local_df = reader(file, **kwargs)
+            break
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(retry_wait * 2 ** attempt)
+            attempt += 1
+    timing = {'file': file, 'seconds': time.time() - time_start,
+              'rows': len(local_df), 'attempts': attempt + 1}
+    return local_df, timing
+
+
+def read_files(file_list, workers=1, retries=0, reader=read_csv_file,
+               **kwargs):
+    """Returns a list of DataFrames and a list of timings for file_list.
+
+       With workers > 1 the files are fetched and parsed by a thread pool,
+       which keeps the node busy while s3 answers. Only workers reads are
+       running at any time. Results are in the same order as file_list."""
+    if workers > 1 and len(file_list) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(read_with_retries, reader, file, retries,
+                                   **kwargs)
+                       for file in file_list]
+            results = [future.result() for future in futures]
     else:
-        dir_list = os.listdir(path)
-        for file in dir_list:
-            local_df = pd.read_csv(file, low_memory=False)
-            dataframe = dataframe.append(local_df)
-    return dir_list
+        results = [read_with_retries(reader, file, retries, **kwargs)
+                   for file in file_list]
+    df_list = [result[0] for result in results]
+    timings = [result[1] for result in results]
+    return df_list, timings
+
+
+def readAllinDir(path, workers=1, retries=0, verbose=False):
+    """Returns a DataFrame with all the CSV files in a directory.
+
+       The directory can be local or in s3. Unlike readAllCSVInPath the
+       compression is inferred from the name of each file."""
+    df_list, timings = read_files(list_path_files(path), workers, retries,
+                                  compression='infer')
+    if verbose:
+        print_timings(timings)
+    return concat_frames(df_list)
+
 
+def print_timings(timings):
+    """Prints how long it took to read each file."""
+    for timing in timings:
+        print("Read %s in %.2fs (%d rows, %d attempts)" %
+              (timing['file'], timing['seconds'], timing['rows'],
+               timing['attempts']))
 
-def readAllCSVInPath(input_path, columns_to_keep=None):
+
+def readAllCSVInPath(input_path, columns_to_keep=None, workers=1, retries=0,
+                     verbose=False, schema=None):
     '''Returns a DataFrame with all CSV in one path.
 
     The path should be a string.
     The path can be both local or in s3.
-    The path can be a directory or a file.'''
-    path = input_path.split('/')
-    # In case we have a final /
-    if len(path[-1]) == 0:
-            path.pop()
-    if path[0] == 's3:':
-        df = pd.DataFrame()
-        bucket_name = path[2]
-        bucket_path = path[3:]
-        final_path = os.path.join(bucket_name, *bucket_path)
-        file_list = fs.ls(final_path)
-        for file in file_list:
-            local_df = pd.read_csv(fs.open(file), compression='gzip', low_memory=False)
+    The path can be a directory or a file.
+    workers > 1 reads that many files at the same time.'''
+    # We keep all the pieces and concatenate once at the end, appending one
+    # by one copies the whole DataFrame every time
+    # Every file gets the same types, so they stay when concatenated
+    df_list, timings = read_files(list_path_files(input_path), workers,
+                                  retries, columns_to_keep=columns_to_keep,
+                                  schema=schema, fixed_schema=True)
+    if verbose:
+        print_timings(timings)
+    return concat_frames(df_list)
+
+
+def iter_csv_chunks(file_list, chunk_rows=1000000, columns_to_keep=None,
+                    memory_budget=None, compression='gzip', schema=None):
+    """Yields DataFrames of chunk_rows rows read across all of file_list.
+
+       Chunks can span more than one file, only the last one can be smaller.
+       If memory_budget (in bytes) is given, chunk_rows is lowered so that a
+       chunk takes roughly that much memory. The size of a row is measured on
+       the first rows read. Files can be local or in s3. If schema is given
+       it is applied to every piece read, with the same types for all of
+       them (see apply_schema). The categories of the chunks can differ,
+       concat_frames joins them keeping the category type."""
+    # Rows used to measure the size of a row in memory
+    probe_rows = 10000
+    buffer = []
+    buffered = 0
+    sized = memory_budget is None
+    for file in file_list:
+        handle, file_compression = open_compressed(file, compression)
+        reader = pd.read_csv(handle, compression=file_compression,
+                             low_memory=False, usecols=columns_to_keep,
+                             iterator=True)
+        while True:
+            if sized:
+                rows_to_read = chunk_rows - buffered
+            else:
+                rows_to_read = min(probe_rows, chunk_rows)
+            try:
+                local_df = reader.get_chunk(rows_to_read)
+            except StopIteration:
+                break
             if columns_to_keep is not None:
                 local_df = local_df[columns_to_keep]
-            df = df.append(local_df)
-    else:
-        # If a file was given
-        if 'gz' in path[-1]:
-            path = os.path.join(*path)
-            df = pd.read_csv(path, compression='gzip', low_memory=False)
-            if columns_to_keep is not None:
-                df = df[columns_to_keep]
-        else:
-            os.chdir(path)
-            for file in os.listdir():
-                local_df = pd.read_csv(file, compression='gzip', low_memory=False)
-                if columns_to_keep is not None:
-                    local_df = local_df[columns_to_keep]
-                df = df.append(local_df)
-    return df
+            if schema is not None:
+                local_df = apply_schema(local_df, schema, fixed=True)
+            if not sized and len(local_df):
+                row_bytes = local_df.memory_usage(deep=True).sum() / len(local_df)
+                chunk_rows = max(1, min(chunk_rows,
+                                        int(memory_budget // row_bytes)))
+                sized = True
+            buffer.append(local_df)
+            buffered += len(local_df)
+            # The probe can be bigger than the chunk size we just found
+            while buffered >= chunk_rows:
+                chunk = concat_frames(buffer, ignore_index=True)
+                yield chunk.iloc[:chunk_rows]
+                buffer = [chunk.iloc[chunk_rows:]]
+                buffered = len(buffer[0])
+        reader.close()
+        if handle is not file:
+            handle.close()
+    if buffered:
+        yield concat_frames(buffer, ignore_index=True)
+
+
+def iter_path_chunks(input_path, chunk_rows=1000000, columns_to_keep=None,
+                     memory_budget=None):
+    """Yields chunks of chunk_rows rows from all the CSV files in a path.
+
+       Same as readAllCSVInPath, but only one chunk is in memory at a time."""
+    return iter_csv_chunks(list_path_files(input_path), chunk_rows,
+                           columns_to_keep, memory_budget)
+
 
 def make_safe_dir(path):
     '''Safely create a local directory.
@@ -99,7 +527,8 @@ def make_safe_dir(path):
     # In case we're somehow fed a number
     path = str(path)
     if not os.path.exists(path):
-        os.makedirs(path, mode=0o700)
+        # Another process can be creating it at the same time
+        os.makedirs(path, mode=0o700, exist_ok=True)
     else:
         # In case the path exists but it's a file we create a random path
         if not os.path.isdir(path):
@@ -109,35 +538,201 @@ def make_safe_dir(path):
     return path
 
 
-def move_to_s3(input_path, destination_bucket, destination_path, keep=False):
+def move_to_s3(input_path, destination_bucket, destination_path, keep=False,
+               part_size=S3_PART_SIZE, threads=S3_UPLOAD_THREADS,
+               retries=S3_RETRIES):
     '''Function to move files to s3.
 
-       If keep=True the file is also kept locally.'''
-    s3.meta.client.upload_file(input_path, destination_bucket,
-                               destination_path)
+       Big files are sent in parts of part_size bytes, threads at the same
+       time. If keep=True the file is also kept locally.'''
+    config = TransferConfig(multipart_threshold=part_size,
+                            multipart_chunksize=part_size,
+                            max_concurrency=threads)
+    attempt = 0
+    while True:
+        try:
+            s3.meta.client.upload_file(input_path, destination_bucket,
+                                       destination_path, Config=config)
+            break
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(2 ** attempt)
+            attempt += 1
     if not keep:
         os.remove(input_path)
     return None
 
 
+class S3Upload(object):
+    '''A file opened for writing in s3, uploaded in parts as it is written.
+
+       Every part_size bytes written a part is sent by a pool of threads,
+       so the upload goes on while the next part is being made (eg:
+       compressed). At most threads parts are kept in memory. Failed parts
+       are sent again up to retries times. Nothing is visible in s3 until
+       close() is called; if there is an error the upload is aborted.
+
+       Use it as a context manager:
+           with S3Upload(bucket, key) as upload:
+               upload.write(data)'''
+
+    def __init__(self, bucket, key, part_size=S3_PART_SIZE,
+                 threads=S3_UPLOAD_THREADS, retries=S3_RETRIES, client=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, 5 * 1024 ** 2)
+        self.threads = threads
+        self.retries = retries
+        if client is None:
+            client = s3.meta.client
+        self.client = client
+        self.buffer = bytearray()
+        self.position = 0
+        self.parts = []
+        self.pending = []
+        self.pool = None
+        self.upload_id = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to a closed S3Upload')
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.send_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def upload_part(self, part_number, body):
+        attempt = 0
+        while True:
+            try:
+                answer = self.client.upload_part(
+                    Bucket=self.bucket, Key=self.key, Body=body,
+                    UploadId=self.upload_id, PartNumber=part_number)
+                return {'PartNumber': part_number, 'ETag': answer['ETag']}
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(2 ** attempt)
+                attempt += 1
+
+    def send_part(self, body):
+        if self.upload_id is None:
+            answer = self.client.create_multipart_upload(Bucket=self.bucket,
+                                                         Key=self.key)
+            self.upload_id = answer['UploadId']
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        # Only threads parts waiting, so memory stays bounded
+        while len(self.pending) >= self.threads:
+            self.parts.append(self.pending.pop(0).result())
+        self.pending.append(self.pool.submit(self.upload_part,
+                                             len(self.parts) +
+                                             len(self.pending) + 1, body))
+
+    def close(self):
+        if self.closed:
+            return None
+        try:
+            if self.upload_id is None:
+                # Small enough for a single request
+                self.client.put_object(Bucket=self.bucket, Key=self.key,
+                                       Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self.send_part(bytes(self.buffer))
+                self.parts += [future.result() for future in self.pending]
+                self.pending = []
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts})
+                self.pool.shutdown()
+        except Exception:
+            self.abort()
+            raise
+        self.buffer = bytearray()
+        self.closed = True
+        return None
+
+    def abort(self):
+        """Cancels the upload, nothing is left in s3."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        if self.upload_id is not None and not self.closed:
+            self.client.abort_multipart_upload(Bucket=self.bucket,
+                                               Key=self.key,
+                                               UploadId=self.upload_id)
+        self.buffer = bytearray()
+        self.closed = True
+        return None
+
+
+def stream_to_s3(dataframe, destination_bucket, destination_path,
+                 output_format='csv', part_size=S3_PART_SIZE,
+                 threads=S3_UPLOAD_THREADS, retries=S3_RETRIES, client=None,
+                 codec=None, level=None, codec_threads=1, stats=None):
+    '''Writes a dataframe straight to s3, without a local copy.
+
+       Same output as write_output (CSV or parquet, with codec). The file
+       is compressed and uploaded in parts at the same time (see S3Upload).
+       Returns the s3 path of the file.'''
+    # Fails early for unknown formats and codecs
+    output_extension(output_format, codec)
+    time_start = time.time()
+    with S3Upload(destination_bucket, destination_path, part_size, threads,
+                  retries, client) as upload:
+        if output_format == 'csv':
+            raw_bytes = write_compressed(upload, iter_csv_bytes(dataframe),
+                                         codec or 'gzip', level,
+                                         codec_threads)
+        else:
+            raw_bytes = dataframe.memory_usage(deep=True).sum()
+            apply_schema(dataframe).to_parquet(
+                upload, index=False, **parquet_compression(codec, level))
+    compression_stats(stats, codec or 'gzip', raw_bytes, upload.tell(),
+                      time.time() - time_start)
+    return 's3://%s/%s' % (destination_bucket, destination_path)
+
+
 def dump_to_clean_cdr(dest_bucket, dataframe, year, month, day,
                       process_name, file_count, to_s3=False, final=False,
-                      yesterday=False, region=False, output_dir='subset'):
-    '''Dumps a cleaned up CDR file to a CSV.'''
+                      yesterday=False, region=False, output_dir='subset',
+                      output_format='csv', part_size=S3_PART_SIZE,
+                      threads=S3_UPLOAD_THREADS, codec=None, level=None,
+                      codec_threads=1, stats=None):
+    '''Dumps a cleaned up CDR file to a CSV (or another OUTPUT_FORMATS).
+
+       With to_s3 the file is streamed to s3 (see stream_to_s3), in parts
+       of part_size bytes sent by threads threads, without a local copy.
+       codec, level and codec_threads are the compression (see CODECS), its
+       ratio and time are put in stats.'''
     if not dataframe.empty:
-        # These files get quite big, so we need to spread them over
-        # all the small disks
-        if int(process_name) % 2 == 0:
-            prefix = '/tmp'
-        else:
-            prefix = os.path.join(os.getenv('HOME'), '.tmp_data/')
-        # Now we make two paths. One for the local storage (split in multiple
-        # small partitions) and the path for s3
-        # If we're storing the files in s3 at the end, we can create a true
-        # tmpdir. Otherwise a systematic name is necessary
-        if to_s3:
-            tmp_path = tempfile.mkdtemp(dir=prefix)
-        else:
+        # The local files get a systematic name
+        if not to_s3:
             tmp_path = os.path.join('CDRs', year, month, day)
             make_safe_dir(tmp_path)
         base_path = 'CDRs/clean_cdrs'
@@ -151,24 +746,564 @@ def dump_to_clean_cdr(dest_bucket, dataframe, year, month, day,
             final_str = '_final'
         else:
             final_str = ''
+        extension = output_extension(output_format, codec)
         # To avoid overwriting the standard files.
         if yesterday:
-            output_name = ('yesterday_cdr_%s_%s.csv.gz' % (str(process_name),
-                           str(file_count)))
+            output_name = ('yesterday_cdr_%s_%s%s' % (str(process_name),
+                           str(file_count), extension))
         else:
-            output_name = ('cdr_%s_%s%s.csv.gz' % (str(process_name),
-                           str(file_count), final_str))
-        # We first dump to a csv so we can compress it.
-        local_path = os.path.join(tmp_path, output_name)
-        dataframe.to_csv(local_path, compression='gzip', index=False)
+            output_name = ('cdr_%s_%s%s%s' % (str(process_name),
+                           str(file_count), final_str, extension))
         # "Directories" within the bucket get created automatically
         if to_s3:
             s3_path = os.path.join(output_path, output_name)
-            move_to_s3(local_path, dest_bucket, s3_path)
-            os.removedirs(tmp_path)
+            stream_to_s3(dataframe, dest_bucket, s3_path, output_format,
+                         part_size, threads, codec=codec, level=level,
+                         codec_threads=codec_threads, stats=stats)
+        else:
+            write_output(dataframe, os.path.join(tmp_path, output_name),
+                         output_format, codec, level, codec_threads, stats)
     return None
 
 
+def list_inputs(path):
+    """Returns a list of (file, etag, size) for all the files in a path.
+
+       For local files the modification time is used as the etag."""
+    if is_s3_path(path) or not os.path.exists(path):
+        input_list = []
+        for info in fs.ls(path, detail=True):
+            if info.get('type', 'file') == 'directory':
+                continue
+            input_list.append((info.get('name', info.get('Key')),
+                               str(info.get('ETag', info.get('etag', ''))),
+                               info.get('size', info.get('Size'))))
+    else:
+        input_list = [(file, str(os.path.getmtime(file)),
+                       os.path.getsize(file))
+                      for file in list_path_files(path)]
+    return input_list
+
+
+def open_manifest(manifest_file):
+    """Returns a connection to a work manifest (SQLite), creating it if needed.
+
+       The manifest keeps the input files of a run, the outputs made with
+       them and whether those outputs were published. Every process must
+       open its own connection."""
+    connection = sqlite3.connect(manifest_file, timeout=600,
+                                 isolation_level=None)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS inputs (
+            key TEXT PRIMARY KEY, etag TEXT, size INTEGER,
+            done INTEGER DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS outputs (
+            staged TEXT PRIMARY KEY, final TEXT,
+            published INTEGER DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS input_outputs (key TEXT, staged TEXT);
+        ''')
+    return connection
+
+
+def register_inputs(connection, input_list):
+    """Adds the (file, etag, size) in input_list to the manifest.
+
+       Files already in the manifest are processed again only if their etag
+       or size changed."""
+    with connection:
+        connection.execute('BEGIN')
+        for key, etag, size in input_list:
+            row = connection.execute('SELECT etag, size FROM inputs '
+                                     'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                connection.execute('INSERT INTO inputs (key, etag, size) '
+                                   'VALUES (?, ?, ?)', (key, etag, size))
+            elif tuple(row) != (etag, size):
+                connection.execute('UPDATE inputs SET etag = ?, size = ?, '
+                                   'done = 0 WHERE key = ?', (etag, size, key))
+    return None
+
+
+def pending_inputs(connection, sizes=False):
+    """Returns the files of the manifest that still have to be processed.
+
+       With sizes=True it returns a list of (file, size)."""
+    rows = connection.execute('SELECT key, size FROM inputs WHERE done = 0 '
+                              'ORDER BY key').fetchall()
+    if sizes:
+        return [(key, size) for key, size in rows]
+    return [row[0] for row in rows]
+
+
+def record_outputs(connection, keys, outputs, done_keys=None):
+    """Records outputs (a list of (staged, final)) made with keys.
+
+       done_keys (all the keys by default) are marked as done: all their
+       outputs are recorded. Everything is recorded in a single transaction,
+       so after a crash an input is either done with all its outputs or not
+       done at all (see discard_unrecorded)."""
+    if done_keys is None:
+        done_keys = keys
+    with connection:
+        connection.execute('BEGIN')
+        for staged, final in outputs:
+            connection.execute('INSERT OR REPLACE INTO outputs (staged, final) '
+                               'VALUES (?, ?)', (staged, final))
+            connection.executemany('INSERT INTO input_outputs (key, staged) '
+                                   'VALUES (?, ?)',
+                                   [(key, staged) for key in keys])
+        connection.executemany('UPDATE inputs SET done = 1 WHERE key = ?',
+                               [(key,) for key in done_keys])
+    return None
+
+
+def discard_incomplete(connection):
+    """Forgets the unpublished outputs made with inputs that are not done.
+
+       Those are outputs of an input with some of its outputs still to be
+       written when the run crashed. The other inputs in those outputs are
+       not done anymore either (and so on with their outputs). Returns the
+       staged files that were forgotten."""
+    discarded = set()
+    while True:
+        rows = connection.execute(
+            'SELECT DISTINCT io.staged FROM input_outputs io '
+            'JOIN inputs i ON i.key = io.key '
+            'JOIN outputs o ON o.staged = io.staged '
+            'WHERE i.done = 0 AND o.published = 0').fetchall()
+        if not rows:
+            break
+        staged_files = [(row[0],) for row in rows]
+        with connection:
+            connection.execute('BEGIN')
+            connection.executemany(
+                'UPDATE inputs SET done = 0 WHERE key IN '
+                '(SELECT key FROM input_outputs WHERE staged = ?)',
+                staged_files)
+            connection.executemany('DELETE FROM input_outputs '
+                                   'WHERE staged = ?', staged_files)
+            connection.executemany('DELETE FROM outputs WHERE staged = ?',
+                                   staged_files)
+        discarded.update(row[0] for row in rows)
+    return discarded
+
+
+def manifest_staging_dir(staging_dir, manifest_file):
+    """Returns the directory in staging_dir for the outputs of a manifest.
+
+       Every manifest gets its own directory, so discard_unrecorded never
+       removes the staged outputs of another manifest (eg: another day)."""
+    name = os.path.splitext(os.path.basename(manifest_file))[0]
+    return os.path.join(staging_dir, name)
+
+
+def discard_unrecorded(connection, staging_path):
+    """Removes the files in staging_path that are not in the manifest.
+
+       Those were written by a run that crashed before recording them, or
+       made with inputs that were not finished (see discard_incomplete).
+       staging_path must only have outputs of this manifest (see
+       manifest_staging_dir)."""
+    discard_incomplete(connection)
+    recorded = set(row[0] for row in
+                   connection.execute('SELECT staged FROM outputs'))
+    if is_s3_path(staging_path):
+        staged_files = ['s3://' + file for file in fs.find(staging_path)]
+    else:
+        staged_files = [os.path.join(root, file)
+                        for root, dirs, files in os.walk(staging_path)
+                        for file in files]
+    for file in staged_files:
+        # The files of a parquet dataset are in the directory that was
+        # recorded
+        path = file
+        while path not in recorded and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        if path not in recorded:
+            if is_s3_path(file):
+                fs.rm(file)
+            else:
+                os.remove(file)
+    return None
+
+
+def publish_outputs(connection):
+    """Moves the staged outputs to their final names once all inputs are done.
+
+       Returns the number of files published, or None if some inputs are
+       still pending. Local files are renamed atomically, files in s3 are
+       moved one by one (s3 has no rename)."""
+    if pending_inputs(connection):
+        return None
+    unpublished = connection.execute('SELECT staged, final FROM outputs '
+                                     'WHERE published = 0').fetchall()
+    for staged, final in unpublished:
+        if is_s3_path(staged):
+            # A parquet dataset is a "directory", its files are moved one
+            # by one (find gives the file itself for a single file)
+            prefix = staged.split('://', 1)[-1]
+            for file in fs.find(staged):
+                fs.mv(file, final + file[len(prefix):])
+        else:
+            make_safe_dir(os.path.dirname(final) or '.')
+            os.replace(staged, final)
+        connection.execute('UPDATE outputs SET published = 1 WHERE staged = ?',
+                           (staged,))
+    return len(unpublished)
+
+
+def make_batches(input_list, batch_size):
+    """Returns a list of batches (lists of files) of about batch_size bytes.
+
+       input_list is a list of (file, size). Small files are grouped so each
+       batch has a similar amount of work, files bigger than batch_size go
+       alone. The biggest batches come first."""
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for file, size in sorted(input_list, key=lambda item: -(item[1] or 0)):
+        batch.append((file, size or 0))
+        batch_bytes += size or 0
+        if batch_bytes >= batch_size:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def make_scheduler(batches, workers):
+    """Returns a scheduler handing batches to workers processes.
+
+       Every worker starts with its own contiguous share of the batches.
+       Once it is done with them, it steals from the end of the share of
+       the worker with most work left. The scheduler must be created before
+       starting the processes and given to them."""
+    ranges = mp.Array('q', 2 * workers)
+    for worker in range(workers):
+        ranges[2 * worker] = len(batches) * worker // workers
+        ranges[2 * worker + 1] = len(batches) * (worker + 1) // workers
+    return {'batches': batches, 'ranges': ranges, 'workers': workers}
+
+
+def next_batch(scheduler, worker):
+    """Returns the next batch for worker and whether it was stolen.
+
+       Returns (None, False) when there is no work left for anybody."""
+    ranges = scheduler['ranges']
+    with ranges.get_lock():
+        head = ranges[2 * worker]
+        if head < ranges[2 * worker + 1]:
+            ranges[2 * worker] = head + 1
+            return scheduler['batches'][head], False
+        left = [ranges[2 * victim + 1] - ranges[2 * victim]
+                for victim in range(scheduler['workers'])]
+        victim = int(np.argmax(left))
+        if left[victim] > 0:
+            ranges[2 * victim + 1] -= 1
+            return scheduler['batches'][ranges[2 * victim + 1]], True
+    return None, False
+
+
+def iter_scheduled_files(scheduler, worker, metrics=None):
+    """Yields the files given to worker by the scheduler.
+
+       The batches, files and bytes are counted in the 'schedule' stage of
+       metrics, if given."""
+    while True:
+        batch, stolen = next_batch(scheduler, worker)
+        if batch is None:
+            break
+        for file, size in batch:
+            yield file
+            if metrics is not None:
+                metrics.count('schedule', size=size, files=1)
+        if metrics is not None:
+            metrics.count('schedule', calls=0, batches=1, stolen=stolen)
+
+
+def split_by_day(dataframe, column='Date'):
+    """Returns a dict of day (as in column) to the rows of that day.
+
+       All the days are found in a single pass. Rows without a day (NaN)
+       are not lost, they go to day NO_DAY."""
+    parts = {int(day): dataframe.iloc[positions] for day, positions
+             in dataframe.groupby(column, sort=False).indices.items()}
+    # groupby leaves out the NaN
+    missing = dataframe[column].isnull().values
+    if missing.any():
+        parts[NO_DAY] = dataframe.iloc[np.flatnonzero(missing)]
+    return parts
+
+
+class DayRouter(object):
+    """Buffers of CDRs per day, written as they fill up.
+
+       Frames are given with add() and split by day (any number of days),
+       or already split with add_days() (eg: by another process). Each day
+       has its own buffer. When it has max_rows rows (or the data
+       of max_keys inputs) spill(day, dataframe, keys, done_keys) is called
+       with the data of the day, the inputs in it and the inputs that have
+       nothing left in any buffer. If all the buffers together go over
+       max_total_rows the biggest one is spilled. flush() spills all of
+       them. spill gets day None and an empty frame for inputs without
+       data."""
+
+    def __init__(self, spill, max_rows=5000000, max_keys=None,
+                 max_total_rows=None, column='Date'):
+        self.spill = spill
+        self.max_rows = max_rows
+        self.max_keys = max_keys
+        self.max_total_rows = max_total_rows
+        self.column = column
+        self.buffers = {}
+        # Days still holding data of every input
+        self.key_days = {}
+        self.total_rows = 0
+
+    def add(self, key, dataframe):
+        return self.add_days(key, split_by_day(dataframe, self.column))
+
+    def add_days(self, key, parts):
+        """parts is a dict of day to the rows of that day (see split_by_day)."""
+        if not parts:
+            self.spill(None, pd.DataFrame(), [key], [key])
+            return None
+        self.key_days.setdefault(key, set()).update(parts)
+        for day, part in parts.items():
+            buffer = self.buffers.setdefault(day, {'keys': [], 'frames': [],
+                                                   'rows': 0})
+            buffer['keys'].append(key)
+            buffer['frames'].append(part)
+            buffer['rows'] += len(part)
+            self.total_rows += len(part)
+        for day in parts:
+            buffer = self.buffers[day]
+            if buffer['rows'] >= self.max_rows or (
+                    self.max_keys is not None and
+                    len(buffer['keys']) >= self.max_keys):
+                self.spill_day(day)
+        while (self.max_total_rows is not None and
+               self.total_rows > self.max_total_rows):
+            self.spill_day(max(self.buffers,
+                               key=lambda day: self.buffers[day]['rows']))
+        return None
+
+    def spill_day(self, day):
+        buffer = self.buffers.pop(day)
+        self.total_rows -= buffer['rows']
+        keys = []
+        done_keys = []
+        seen = set()
+        for key in buffer['keys']:
+            if key in seen:
+                continue
+            seen.add(key)
+            keys.append(key)
+            self.key_days[key].discard(day)
+            if not self.key_days[key]:
+                del self.key_days[key]
+                done_keys.append(key)
+        self.spill(day, concat_frames(buffer['frames']), keys, done_keys)
+        return None
+
+    def flush(self):
+        for day in sorted(self.buffers):
+            self.spill_day(day)
+        return None
+
+
+def current_rss():
+    """Returns the memory (RSS) used by this process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # Without /proc we can only know the peak (in KB)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics(object):
+    """Timers and counters of the stages (list, read, parse, filter,
+       compress, upload...) of a process.
+
+       Every stage has calls, seconds, rows and bytes, plus any other
+       counter given. The metrics are written as JSON lines to metrics_file
+       every interval seconds (or printed without a file), with the rows/s
+       and bytes/s of each stage, the depth of the queues and the RSS. Each
+       process keeps its own Metrics and close() writes its summary (see
+       summarize_metrics). With profile_dir the process is run under
+       cProfile and its stats are saved there as <name>.prof. Single events
+       (eg: every file written, with its compression ratio) are written
+       with log().
+
+           metrics = Metrics('reader-0', 'metrics.jsonl')
+           with metrics.timer('read') as counter:
+               dataframe = read_csv_file(file)
+               counter['rows'] = len(dataframe)
+           metrics.close()"""
+
+    def __init__(self, name=None, metrics_file=None, interval=30,
+                 profile_dir=None):
+        if name is None:
+            name = mp.current_process().name
+        self.name = name
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.stages = {}
+        self.queues = {}
+        self.time_start = time.time()
+        self.last_emit = self.time_start
+        self.profiler = None
+        if profile_dir is not None:
+            # Every process may be creating it at the same time
+            os.makedirs(profile_dir, exist_ok=True)
+            self.profile_file = os.path.join(profile_dir, name + '.prof')
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def count(self, stage, rows=0, size=0, seconds=0., calls=1, **counters):
+        """Adds to the counters of stage."""
+        stage_counters = self.stages.setdefault(stage, {'calls': 0,
+                                                        'seconds': 0.,
+                                                        'rows': 0,
+                                                        'bytes': 0})
+        stage_counters['calls'] += calls
+        stage_counters['seconds'] += seconds
+        stage_counters['rows'] += int(rows)
+        stage_counters['bytes'] += int(size)
+        for counter, value in counters.items():
+            stage_counters[counter] = stage_counters.get(counter, 0) + value
+        if time.time() - self.last_emit >= self.interval:
+            self.emit()
+        return None
+
+    @contextlib.contextmanager
+    def timer(self, stage, rows=0, size=0):
+        """Times the code in a with block as a call of stage.
+
+           Yields a dict where the rows and bytes (or other counters) can
+           be set when they are only known at the end."""
+        counter = {'rows': rows, 'bytes': size}
+        time_start = time.time()
+        yield counter
+        seconds = time.time() - time_start
+        counters = dict(counter)
+        self.count(stage, counters.pop('rows'), counters.pop('bytes'), seconds,
+                   **counters)
+
+    def queue(self, name, queue):
+        """Records the number of items waiting in queue."""
+        try:
+            self.queues[name] = queue.qsize()
+        except NotImplementedError:
+            # macOS
+            pass
+        return None
+
+    def report(self):
+        """Returns a dict with the current metrics."""
+        now = time.time()
+        stages = {}
+        for stage, counters in self.stages.items():
+            stages[stage] = dict(counters)
+            seconds = max(counters['seconds'], 1e-9)
+            stages[stage]['rows_per_second'] = counters['rows'] / seconds
+            stages[stage]['bytes_per_second'] = counters['bytes'] / seconds
+        return {'time': now, 'process': self.name,
+                'elapsed': now - self.time_start, 'rss': current_rss(),
+                'queues': dict(self.queues), 'stages': stages}
+
+    def emit(self, event='progress'):
+        """Writes the current metrics as a JSON line."""
+        record = self.report()
+        record['event'] = event
+        self.write(record)
+        self.last_emit = time.time()
+        return None
+
+    def log(self, event, **values):
+        """Writes a JSON line with a single event of the process."""
+        record = {'time': time.time(), 'process': self.name, 'event': event}
+        record.update(values)
+        self.write(record)
+        return None
+
+    def write(self, record):
+        """Writes a record (a dict) as a JSON line."""
+        line = json.dumps(record, sort_keys=True, default=float)
+        if self.metrics_file is None:
+            print(line)
+        else:
+            # Small appends, so the lines of the processes don't get mixed
+            with open(self.metrics_file, 'a') as output:
+                output.write(line + '\n')
+        return None
+
+    def close(self):
+        """Writes the summary of the process (and its profile)."""
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_file)
+            self.profiler = None
+        self.emit('summary')
+        return None
+
+
+def read_metrics(metrics_file):
+    """Returns the list of records of a JSON lines metrics file."""
+    with open(metrics_file) as metrics:
+        return [json.loads(line) for line in metrics if line.strip()]
+
+
+def summarize_metrics(metrics_file, verbose=True):
+    """Returns a DataFrame with the totals of every stage of a run.
+
+       Uses the summary of every process in metrics_file (their last
+       record if they died before it). rows/s and MB/s are per process
+       busy in the stage. ratio is the compression ratio of the stages
+       that count raw_bytes. With verbose the table and the peak RSS are
+       printed."""
+    records = [record for record in read_metrics(metrics_file)
+               if record['event'] in ('progress', 'summary')]
+    last = {}
+    for record in records:
+        if record['event'] == 'summary' or record['process'] not in last:
+            last[record['process']] = record
+        elif last[record['process']]['event'] != 'summary':
+            last[record['process']] = record
+    rows = []
+    for record in last.values():
+        for stage, counters in record['stages'].items():
+            rows.append({'stage': stage, 'process': record['process'],
+                         'calls': counters['calls'],
+                         'seconds': counters['seconds'],
+                         'rows': counters['rows'],
+                         'bytes': counters['bytes'],
+                         'raw_bytes': counters.get('raw_bytes', 0)})
+    columns = ['stage', 'processes', 'calls', 'seconds', 'rows', 'bytes']
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    summary_df = pd.DataFrame(rows).groupby('stage').agg(
+        processes=('process', 'nunique'), calls=('calls', 'sum'),
+        seconds=('seconds', 'sum'), rows=('rows', 'sum'),
+        bytes=('bytes', 'sum'), raw_bytes=('raw_bytes', 'sum')).reset_index()
+    raw_bytes = summary_df.pop('raw_bytes')
+    summary_df = summary_df[columns]
+    seconds = summary_df['seconds'].clip(lower=1e-9)
+    summary_df['rows_per_second'] = summary_df['rows'] / seconds
+    summary_df['MB_per_second'] = summary_df['bytes'] / seconds / 2 ** 20
+    if raw_bytes.any():
+        summary_df['ratio'] = (raw_bytes / summary_df['bytes'].clip(lower=1)
+                               ).where(raw_bytes > 0)
+    if verbose:
+        print(summary_df.to_string(index=False, float_format='%.1f'))
+        peak = max(record['rss'] for record in records)
+        print("Peak RSS of a process: %.1f MB" % (peak / 2 ** 20))
+    return summary_df
+
+
 def add_to_name(input_name, string_to_add):
     '''Returns a name with a string appended.
 
@@ -202,6 +1337,124 @@ def PointInWhichRegion(latitude, longitude, area_dataframe):
     return local_result
 
 
+def make_region_tree(area_dataframe):
+    """Returns a spatial index (STRtree) of the polygons in area_dataframe."""
+    from shapely.strtree import STRtree
+    return STRtree(list(area_dataframe.geometry))
+
+
+def query_regions(latitudes, longitudes, area_dataframe, tree=None):
+    """Returns the position in area_dataframe of the first polygon that
+       contains each point, or len(area_dataframe) if none does.
+
+       Only the polygons whose bounding box contains the point are tested.
+       With shapely >= 2 all the points are queried at once, with shapely
+       1.x one by one."""
+    import shapely
+    if tree is None:
+        tree = make_region_tree(area_dataframe)
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    first_area = np.full(len(latitudes), len(area_dataframe), dtype=np.int64)
+    if not hasattr(shapely, 'points'):
+        polygons = list(area_dataframe.geometry)
+        # The tree of shapely 1.x returns the polygons, not their position
+        positions = {id(polygon): i for i, polygon in enumerate(polygons)}
+        for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+            position = Point(longitude, latitude)
+            candidates = sorted(positions[id(polygon)]
+                                for polygon in tree.query(position))
+            for area in candidates:
+                if polygons[area].intersects(position):
+                    first_area[i] = area
+                    break
+        return first_area
+    # Again longitude/latitude because of the source data
+    points = shapely.points(longitudes, latitudes)
+    point_idx, area_idx = tree.query(points, predicate='intersects')
+    # Several polygons can match a point, we keep the first one like
+    # PointInWhichRegion does
+    np.minimum.at(first_area, point_idx, area_idx)
+    return first_area
+
+
+def arePointsInRegion(latitudes, longitudes, area_dataframe, tree=None):
+    """Returns a boolean array, isPointInRegion for a list of points."""
+    first_area = query_regions(latitudes, longitudes, area_dataframe, tree)
+    return first_area < len(area_dataframe)
+
+
+def PointsInWhichRegion(latitudes, longitudes, area_dataframe, tree=None):
+    """Returns an array of regions, PointInWhichRegion for a list of points.
+
+       Points outside of every region get 0. A tree from make_region_tree
+       can be given to reuse it between calls."""
+    first_area = query_regions(latitudes, longitudes, area_dataframe, tree)
+    found = first_area < len(area_dataframe)
+    zone_ids = np.asarray(area_dataframe['id'])
+    if zone_ids.dtype.kind in 'iuf':
+        result = np.zeros(len(first_area), dtype=zone_ids.dtype)
+    else:
+        result = np.zeros(len(first_area), dtype=object)
+    result[found] = zone_ids[first_area[found]]
+    return result
+
+
+def hash_file(input_file, block_size=2 ** 20):
+    """Returns the sha256 of the contents of a file (local or in s3)."""
+    digest = hashlib.sha256()
+    if is_s3_path(input_file):
+        handle = fs.open(input_file, 'rb')
+    else:
+        handle = open(input_file, 'rb')
+    with handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_regions(area_dataframe):
+    """Returns the sha256 of the ids and polygons of area_dataframe."""
+    digest = hashlib.sha256()
+    digest.update(np.asarray(area_dataframe['id']).astype(str).tobytes())
+    for polygon in area_dataframe.geometry:
+        digest.update(polygon.wkb)
+    return digest.hexdigest()
+
+
+def cell_zone_lookup(cell_file, area_dataframe, cache_dir=CACHE_DIR):
+    """Returns a DataFrame with the zone, municipality and region of every
+       Cell ID in cell_file.
+
+       The result is stored as parquet in cache_dir under a name made from
+       the contents of cell_file and area_dataframe, so it is only computed
+       again when one of them changes. Cells outside of every zone get 0
+       ('0' if the ids of area_dataframe are text)."""
+    key = hashlib.sha256((hash_file(cell_file) + hash_regions(area_dataframe))
+                         .encode()).hexdigest()
+    cache_file = os.path.join(make_safe_dir(cache_dir),
+                              'cell_zones_%s.parquet' % key)
+    if os.path.exists(cache_file):
+        return pd.read_parquet(cache_file)
+    cell_df = read_csv_file(cell_file)
+    cid_df = makeCIDLatLon(cell_df)
+    for column in ['Municipal_Code', 'Region_Code']:
+        if column in cell_df.columns:
+            cid_df[column] = cell_df[column].loc[cid_df.index].values
+    cid_df['Zone'] = PointsInWhichRegion(cid_df['Latitude'],
+                                         cid_df['Longitude'], area_dataframe)
+    if cid_df['Zone'].dtype == object:
+        # parquet needs one type for the whole column
+        cid_df['Zone'] = cid_df['Zone'].astype(str)
+    zone_df = cid_df.drop(columns=['Latitude', 'Longitude']).reset_index(drop=True)
+    # We write to a temporary name first so a crash doesn't leave a
+    # half written file in the cache
+    tmp_file = cache_file + '.%d.tmp' % os.getpid()
+    zone_df.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, cache_file)
+    return zone_df
+
+
 def expand_arguments(municipalities=None, regions=None):
     """Returns a set of arguments for names and extraction data.
 
@@ -242,17 +1495,24 @@ def extract_zone(cell_dataframe, column, area):
 
 
 def make_zone_df(cell_dataframe, zone_data, column_data, full=False):
-    """Returns a cell dataframe for a small zone."""
+    """Returns a cell dataframe for a small zone.
+
+       Rows come in the order of the zones asked for. A cell that is in
+       more than one of the zones appears once for each of them."""
     zone_df = pd.DataFrame()
     if full:
         zone_df = cell_dataframe
     else:
+        # Positions of the rows of every zone, computed in a single pass per
+        # column instead of one scan per zone
+        positions = []
+        no_rows = np.array([], dtype=np.int64)
         for i in range(len(zone_data)):
-            zone_list = zone_data[i]
-            for zone in zone_list:
-                local_df = extract_zone(cell_dataframe, column_data[i],
-                                        int(zone))
-                zone_df = zone_df.append(local_df)
+            zone_index = cell_dataframe.groupby(column_data[i]).indices
+            positions += [zone_index.get(int(zone), no_rows)
+                          for zone in zone_data[i]]
+        if positions:
+            zone_df = cell_dataframe.iloc[np.concatenate(positions)]
     return zone_df
 
 
@@ -267,6 +1527,47 @@ def makeCIDset(cell_dataframe):
     return cid_set
 
 
+def makeCIDarray(cell_dataframe):
+    """Returns a sorted NumPy array with all the valid CID in the dataframe.
+
+       Same CID as makeCIDset, but compact and usable with isInCIDarray.
+       Empty cells (NaN) are left out."""
+    cid_columns = [column for column in cell_dataframe.columns
+                   if 'CID' in str(column)]
+    cid_values = pd.to_numeric(pd.Series(cell_dataframe[cid_columns].values
+                                         .ravel())).dropna()
+    cid_array = np.unique(cid_values.values.astype(np.int64))
+    return cid_array[cid_array != -1]
+
+
+def share_CIDarray(cid_array):
+    """Returns a copy of a CID array in shared memory.
+
+       The result can be given to the worker processes instead of the cell
+       DataFrame. They get a view of it with CIDarray_from_shared."""
+    shared = mp.RawArray('q', len(cid_array))
+    CIDarray_from_shared(shared)[:] = cid_array
+    return shared
+
+
+def CIDarray_from_shared(shared):
+    """Returns a NumPy view (no copy) of a CID array in shared memory."""
+    return np.frombuffer(shared, dtype=np.int64)
+
+
+def isInCIDarray(cid_values, cid_array):
+    """Returns a boolean array, True where cid_values are in cid_array.
+
+       cid_array must be sorted (like the output of makeCIDarray), so a whole
+       column of a CDR chunk is tested with a binary search."""
+    cid_values = np.asarray(cid_values)
+    if not len(cid_array):
+        return np.zeros(len(cid_values), dtype=bool)
+    position = np.searchsorted(cid_array, cid_values)
+    position[position == len(cid_array)] = 0
+    return cid_array[position] == cid_values
+
+
 def isDayHoliday(holiday_dataframe, year, month, day, region=0, country='spain'):
     """Returns a boolean on weather a day is an holiday.
 
@@ -278,6 +1579,58 @@ def isDayHoliday(holiday_dataframe, year, month, day, region=0, country='spain')
     return holiday
 
 
+class HolidayCalendar(object):
+    """Holidays of a country, indexed by (region, month, day).
+
+       Answers the same as isDayHoliday (the year is not used and the region
+       must match), for one day or for whole Date/region columns."""
+
+    def __init__(self, holiday_dataframe, country='spain'):
+        self.country = country
+        self.keys = np.unique(self.make_keys(holiday_dataframe.region.values,
+                                             holiday_dataframe.month.values,
+                                             holiday_dataframe.day.values))
+        self.key_set = set(self.keys.tolist())
+
+    @staticmethod
+    def make_keys(region, month, day):
+        """Returns the keys of the index: region, month and day packed."""
+        return (np.asarray(region, dtype=np.int64) * 10000
+                + np.asarray(month, dtype=np.int64) * 100
+                + np.asarray(day, dtype=np.int64))
+
+    def isHoliday(self, year, month, day, region=0):
+        """Returns a boolean on whether a day is a holiday in region."""
+        return int(region) * 10000 + int(month) * 100 + int(day) in self.key_set
+
+    def areHolidays(self, dates, regions=0):
+        """Returns a boolean array for our YYYYMMDD dates.
+
+           regions can be a single region or one per date."""
+        dates = np.asarray(dates, dtype=np.int64)
+        keys = self.make_keys(regions, dates // 100 % 100, dates % 100)
+        return np.isin(keys, self.keys)
+
+
+# Calendars already loaded, by country
+holiday_calendars = {}
+
+
+def getHolidayCalendar(country='spain', holiday_dataframe=None):
+    """Returns the HolidayCalendar of a country, loading it only once.
+
+       If holiday_dataframe is not given, the holidays are read from
+       DIR_HOLIDAYS/<country> (a CSV file or a directory of them) with
+       columns month, day and region."""
+    if country not in holiday_calendars:
+        if holiday_dataframe is None:
+            holiday_dataframe = readAllinDir(os.path.join(DIR_HOLIDAYS,
+                                                          country))
+        holiday_calendars[country] = HolidayCalendar(holiday_dataframe,
+                                                     country)
+    return holiday_calendars[country]
+
+
 # PROBABLY deprecated!
 def fromTimestampToPeriod(timestamp, isHoliday):
     """Returns a string identifying a time period."""
@@ -346,14 +1699,104 @@ def getTimePeriod(weekday, hour):
     return period
 
 
+# Periods returned by getTimePeriod and their value for every weekday/hour,
+# so whole columns can be classified at once
+TIME_PERIODS = ['night', 'work', 'weekend']
+PERIOD_TABLE = np.array([[TIME_PERIODS.index(getTimePeriod(weekday, hour))
+                          for hour in range(24)] for weekday in range(7)],
+                        dtype=np.int8)
+
+
+def getTimePeriods(weekdays, hours, isHoliday=False):
+    """Returns a Categorical with getTimePeriod of every weekday/hour.
+
+       isHoliday can be a single boolean or one per event. Holidays are
+       classified as Sundays, like in fromTimestampToPeriod."""
+    weekdays = np.where(isHoliday, 6, np.asarray(weekdays, dtype=np.int64))
+    codes = PERIOD_TABLE[weekdays, np.asarray(hours, dtype=np.int64)]
+    return pd.Categorical.from_codes(codes, TIME_PERIODS)
+
+
+def fromTimestampsToPeriods(timestamps, isHoliday=False):
+    """Returns a Categorical with fromTimestampToPeriod of every timestamp."""
+    timestamps = np.floor(np.asarray(timestamps, dtype=np.float64)).astype(np.int64)
+    days = timestamps // 86400
+    # 1970-01-01 was a Thursday (Mon = 0)
+    weekdays = (days + 3) % 7
+    hours = timestamps % 86400 // 3600
+    return getTimePeriods(weekdays, hours, isHoliday)
+
+
+def fromDateTimeToPeriods(dates, times, isHoliday=False):
+    """Returns a Categorical with the period of every (Date, Time) pair.
+
+       Date and Time are our YYYYMMDD and HHMMSS integers."""
+    # There are only a few different days in a chunk of CDRs
+    unique_dates, date_index = np.unique(np.asarray(dates, dtype=np.int64),
+                                         return_inverse=True)
+    unique_weekdays = pd.to_datetime(pd.DataFrame({
+        'year': unique_dates // 10000, 'month': unique_dates // 100 % 100,
+        'day': unique_dates % 100})).dt.dayofweek.values
+    hours = np.asarray(times, dtype=np.int64) // 10000
+    return getTimePeriods(unique_weekdays[date_index], hours, isHoliday)
+
+
 def makeDateHourColumns(cdr_dataframe):
     '''Returns a DataFrame with extra columns for Year, Month, Day and Hour.'''
-    cdr_dataframe['Year'] = cdr_dataframe['Date'] // 10000
-    cdr_dataframe['Month'] = (cdr_dataframe['Date'] - cdr_dataframe['Year'] * 10000) // 100
-    cdr_dataframe['Day'] = (cdr_dataframe['Date'] - cdr_dataframe['Year'] * 10000
-                       - cdr_dataframe['Month'] * 100)
-    cdr_dataframe['Hour'] = cdr_dataframe['Time'] // 10000
     # Probably we don't need minute/second
+    return makeDateTimeColumns(cdr_dataframe)
+
+
+def days_from_civil(year, month, day):
+    '''Returns the days since 1970-01-01 of arrays of year, month and day.
+
+       Integer arithmetic only, it works on whole columns at once.'''
+    # Years start in March so the leap day is the last day of the year
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = (year_of_era * 365 + year_of_era // 4 - year_of_era // 100
+                  + day_of_year)
+    return era * 146097 + day_of_era - 719468
+
+
+def makeDateTimeColumns(cdr_dataframe, date_columns=True,
+                        datetime_column=None):
+    '''Adds columns made from the YYYYMMDD Date and HHMMSS Time integers.
+
+       date_columns adds Year, Month, Day and Hour (small integer types,
+       nullable ones like UInt8 if some Date or Time is missing).
+       datetime_column is the name of a datetime64 column to add, if any
+       (NaT where Date or Time is missing). The dataframe (eg: a chunk of
+       CDRs) is modified in place and returned.'''
+    date_missing = cdr_dataframe['Date'].isnull().values
+    time_missing = cdr_dataframe['Time'].isnull().values
+    # Both numbers are split with divmod, reusing the arrays
+    year, day = np.divmod(cdr_dataframe['Date'].fillna(0).values.astype(np.int64),
+                          10000)
+    month, day = np.divmod(day, 100, out=(np.empty_like(day), day))
+    hour, second = np.divmod(cdr_dataframe['Time'].fillna(0).values.astype(np.int64),
+                             10000)
+    minute, second = np.divmod(second, 100, out=(np.empty_like(second), second))
+    if date_columns:
+        # Years fit in 16 bits and the rest in 8 bits (see CDR_SCHEMA)
+        for column, values, missing in [('Year', year.astype(np.uint16), date_missing),
+                                        ('Month', month.astype(np.uint8), date_missing),
+                                        ('Day', day.astype(np.uint8), date_missing),
+                                        ('Hour', hour.astype(np.uint8), time_missing)]:
+            if missing.any():
+                values = pd.arrays.IntegerArray(values, missing)
+            cdr_dataframe[column] = values
+    if datetime_column is not None:
+        time_epoch = days_from_civil(year, month, day)
+        time_epoch *= 86400
+        time_epoch += hour * 3600
+        time_epoch += minute * 60
+        time_epoch += second
+        time_epoch = time_epoch.astype('datetime64[s]').astype('datetime64[ns]')
+        time_epoch[date_missing | time_missing] = np.datetime64('NaT')
+        cdr_dataframe[datetime_column] = time_epoch
     return cdr_dataframe
 
 
@@ -364,33 +1807,317 @@ def GetAllAtPosition(cell_dataframe, latitude, longitude):
 
 def makeCIDLatLon(cell_dataframe):
     """Returns an expanded dataframe with only three components CID, Latitude, Longitude"""
-    full_df = pd.DataFrame()
-    for cid in cell_dataframe.loc[:, 'CID_1':].columns:
-        local_df = cell_dataframe.loc[:, ['Latitude', 'Longitude', cid]]
-        local_df.columns = ['Latitude', 'Longitude', 'Cell ID']
-        local_df = local_df[local_df['Cell ID'] > 0]
-        full_df = full_df.append(local_df)
-    return full_df
+    # One block with all the CID columns, one after the other (column-major)
+    cid_values = cell_dataframe.loc[:, 'CID_1':].values
+    columns = cid_values.shape[1]
+    full_df = pd.DataFrame({
+        'Latitude': np.tile(cell_dataframe['Latitude'].values, columns),
+        'Longitude': np.tile(cell_dataframe['Longitude'].values, columns),
+        'Cell ID': cid_values.ravel(order='F')},
+        index=np.tile(cell_dataframe.index.values, columns),
+        columns=['Latitude', 'Longitude', 'Cell ID'])
+    return full_df[full_df['Cell ID'].values > 0]
+
+
+class CellIndex(object):
+    """Coordinates of the cells of a cell DataFrame, indexed for lookups.
+
+       Each index is built the first time it is needed:
+       - by CID (getPosition, enrich)
+       - by exact position (getAllAtPosition)
+       - by distance, with a KD-tree (nearest)"""
+
+    # Mean radius of the Earth, in km
+    EARTH_RADIUS = 6371.0
+
+    def __init__(self, cell_dataframe):
+        self.cell_dataframe = cell_dataframe
+        self.cid_df = None
+        self.cid_index = None
+        self.position_index = None
+        self.tree = None
+
+    def build_cid_index(self):
+        if self.cid_index is None:
+            cid_df = makeCIDLatLon(self.cell_dataframe)
+            # A CID in more than one row keeps the first position
+            cid_df = cid_df.drop_duplicates('Cell ID')
+            self.cid_df = cid_df.reset_index(drop=True)
+            self.cid_index = pd.Index(self.cid_df['Cell ID'].values)
+        return self.cid_index
+
+    def getPosition(self, cid):
+        """Returns (latitude, longitude) of a CID, or None if not found."""
+        cid_index = self.build_cid_index()
+        if cid not in cid_index:
+            return None
+        row = self.cid_df.iloc[cid_index.get_loc(cid)]
+        return row['Latitude'], row['Longitude']
+
+    def enrich(self, cdr_dataframe, cell_column='Start Cell'):
+        """Adds the Latitude and Longitude of cell_column to cdr_dataframe.
+
+           Unknown cells get NaN. The dataframe (eg: a chunk of CDRs) is
+           modified in place and returned, ready for COLUMNS_TO_SAVE."""
+        position = self.build_cid_index().get_indexer(cdr_dataframe[cell_column].values)
+        found = position >= 0
+        for column in ['Latitude', 'Longitude']:
+            values = np.full(len(position), np.nan)
+            values[found] = self.cid_df[column].values[position[found]]
+            cdr_dataframe[column] = values
+        return cdr_dataframe
+
+    def getAllAtPosition(self, latitude, longitude):
+        """Returns the dataframe of all cells at the same latitude/longitude.
 
+           Same as GetAllAtPosition, without scanning all the cells."""
+        if self.position_index is None:
+            self.position_index = self.cell_dataframe.groupby(
+                ['Latitude', 'Longitude']).indices
+        rows = self.position_index.get((latitude, longitude),
+                                       np.array([], dtype=np.int64))
+        return self.cell_dataframe.iloc[rows]
 
-def read_csv(input_file):
+    def to_unit_vectors(self, latitudes, longitudes):
+        latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+        longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+        return np.column_stack([np.cos(latitudes) * np.cos(longitudes),
+                                np.cos(latitudes) * np.sin(longitudes),
+                                np.sin(latitudes)])
+
+    def nearest(self, latitudes, longitudes, k=1):
+        """Returns the distances (km) and rows of the k cells closest to
+           each point.
+
+           Rows are positions in the cell DataFrame (for iloc). The search
+           is done with a KD-tree on points on the sphere, so distances are
+           great-circle distances."""
+        if self.tree is None:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.to_unit_vectors(
+                self.cell_dataframe['Latitude'].values,
+                self.cell_dataframe['Longitude'].values))
+        chord, rows = self.tree.query(self.to_unit_vectors(latitudes,
+                                                           longitudes), k=k)
+        distance = 2 * self.EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+        return distance, rows
+
+
+def read_csv(input_file, retries=0):
     """Returns a DataFrame that is read from one of our (CDR) files.
 
        It controls for whether the file is in a S3 bucket or not."""
-    input_path = input_file.split('/')
-    if input_path[0] == 's3:':
-        bucket_name = input_path[2]
-        bucket_path = input_path[3:]
-        file = os.path.join(bucket_name, *bucket_path)
-        local_df = pd.read_csv(fs.open(file), compression='gzip',
-                             low_memory=False)
-    else:
-        local_df = pd.read_csv(input_file, compression='gzip', low_memory=False)
+    local_df, timing = read_with_retries(read_csv_file, input_file, retries)
     return local_df
 
-def write_csv(dataframe, output_file, separator=',', add_index=False):
-    """Creates a CSV file with gzip compression of the dataframe."""
-    if not output_file.endswith('.gz'):
-        output_file += '.gz'
-    dataframe.to_csv(output_file, compression='gzip', index=add_index,
-                     sep=separator)
+def output_extension(output_format='csv', codec=None):
+    """Returns the extension of the files of an output format and codec."""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format '%s', use one of: %s" %
+                         (output_format, ', '.join(OUTPUT_FORMATS)))
+    if output_format == 'csv' and codec is not None:
+        if codec not in CODECS:
+            raise ValueError("Unknown codec '%s', use one of: %s" %
+                             (codec, ', '.join(CODECS)))
+        return '.csv' + CODECS[codec]
+    return OUTPUT_FORMATS[output_format]
+
+
+class BlockGzipWriter(object):
+    """A file object that compresses what is written as gzip, in parallel.
+
+       Every block_size bytes are compressed as a gzip member by a pool of
+       threads (zlib releases the GIL) and written to output in order. Any
+       gzip reader reads the members as a single file. At most threads
+       blocks are waiting. close() does not close output."""
+
+    def __init__(self, output, level=CODEC_LEVELS['pgzip'], threads=4,
+                 block_size=PGZIP_BLOCK_SIZE):
+        self.output = output
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = []
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def send_block(self, block):
+        while len(self.pending) >= self.threads:
+            self.output.write(self.pending.pop(0).result())
+        self.pending.append(self.pool.submit(gzip.compress, block,
+                                             self.level))
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.send_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        # An empty file still needs a gzip member
+        if self.buffer or not self.pending:
+            self.send_block(bytes(self.buffer))
+        for future in self.pending:
+            self.output.write(future.result())
+        self.buffer = bytearray()
+        self.pending = []
+        self.pool.shutdown()
+        return None
+
+
+def write_compressed(output, chunks, codec='gzip', level=None, threads=1):
+    """Writes the bytes in chunks to the binary file output, compressed
+       with one of the CODECS.
+
+       threads is used by pgzip and zstd. output is not closed. Returns
+       the number of bytes before compression."""
+    if codec not in CODECS:
+        raise ValueError("Unknown codec '%s', use one of: %s" %
+                         (codec, ', '.join(CODECS)))
+    if level is None:
+        level = CODEC_LEVELS[codec]
+    if codec == 'gzip':
+        stream = gzip.GzipFile(fileobj=output, mode='wb', compresslevel=level)
+    elif codec == 'pgzip':
+        stream = BlockGzipWriter(output, level, threads)
+    elif codec == 'zstd':
+        import zstandard
+        # threads=0 is zstd without worker threads
+        stream = zstandard.ZstdCompressor(level=level,
+                                          threads=threads if threads > 1 else 0
+                                          ).stream_writer(output)
+    elif codec == 'lz4':
+        import lz4.frame
+        stream = lz4.frame.LZ4FrameFile(output, 'wb', compression_level=level)
+    else:
+        stream = output
+    raw_bytes = 0
+    for chunk in chunks:
+        stream.write(chunk)
+        raw_bytes += len(chunk)
+    if codec == 'zstd':
+        stream.flush(zstandard.FLUSH_FRAME)
+    elif codec != 'none':
+        stream.close()
+    return raw_bytes
+
+
+def iter_csv_bytes(dataframe, separator=',', add_index=False,
+                   chunk_rows=CSV_CHUNK_ROWS):
+    """Yields the CSV of the dataframe (as bytes), chunk_rows rows at once."""
+    for start in range(0, max(len(dataframe), 1), chunk_rows):
+        yield dataframe.iloc[start:start + chunk_rows].to_csv(
+            sep=separator, index=add_index, header=start == 0).encode('utf-8')
+
+
+def compression_stats(stats, codec, raw_bytes, compressed_bytes, seconds):
+    """Puts the size, compression ratio and time of a write in stats."""
+    raw_bytes = int(raw_bytes)
+    if stats is not None:
+        stats.update({'codec': codec, 'raw_bytes': raw_bytes,
+                      'bytes': compressed_bytes,
+                      'ratio': raw_bytes / max(compressed_bytes, 1),
+                      'seconds': seconds})
+    return stats
+
+
+def parquet_compression(codec=None, level=None):
+    """Returns the arguments of to_parquet for one of the CODECS."""
+    if codec is None:
+        return {}
+    compression = {'pgzip': 'gzip', 'none': None}.get(codec, codec)
+    if level is None:
+        return {'compression': compression}
+    return {'compression': compression, 'compression_level': level}
+
+
+def write_csv(dataframe, output_file, separator=',', add_index=False,
+              codec='gzip', level=None, codec_threads=1, stats=None):
+    """Creates a CSV file of the dataframe compressed with one of CODECS.
+
+       The extension of the codec is added to output_file if missing. If a
+       dict is given as stats, the compression ratio and time of the file
+       are put in it."""
+    extension = output_extension('csv', codec)[len('.csv'):]
+    if not output_file.endswith(extension):
+        output_file += extension
+    time_start = time.time()
+    with open(output_file, 'wb') as output:
+        raw_bytes = write_compressed(output, iter_csv_bytes(dataframe,
+                                                            separator,
+                                                            add_index),
+                                     codec, level, codec_threads)
+    compression_stats(stats, codec, raw_bytes, os.path.getsize(output_file),
+                      time.time() - time_start)
+    return output_file
+
+
+def write_parquet(dataframe, output_file, add_index=False, partition_cols=None,
+                  schema=CDR_SCHEMA, codec=None, level=None, stats=None):
+    """Creates a Parquet file of the dataframe, keeping the column types.
+
+       If partition_cols is given (eg: PARTITION_COLUMNS), output_file is a
+       directory with one subdirectory per value of the columns. Year, Month
+       and Day are made from Date if they are missing. The column types of
+       schema are used when the values fit. codec (one of CODECS) replaces
+       the default compression of parquet. The ratio in stats is the one to
+       the size of the dataframe in memory."""
+    time_start = time.time()
+    dataframe = dataframe.copy()
+    if partition_cols is not None:
+        missing = [column for column in partition_cols
+                   if column not in dataframe.columns]
+        if missing and set(missing) <= set(PARTITION_COLUMNS):
+            dataframe = makeDateHourColumns(dataframe)
+            # pyarrow can't read back empty partitions, the rows without a
+            # date go to Year=0/Month=0/Day=0 (see NO_DAY)
+            for column in PARTITION_COLUMNS:
+                if dataframe[column].isnull().any():
+                    dataframe[column] = dataframe[column].fillna(NO_DAY).astype(
+                        CDR_SCHEMA[column])
+    if schema is not None:
+        dataframe = apply_schema(dataframe, schema)
+    if partition_cols is None and not output_file.endswith('.parquet'):
+        output_file += '.parquet'
+    dataframe.to_parquet(output_file, index=add_index,
+                         partition_cols=partition_cols,
+                         **parquet_compression(codec, level))
+    if os.path.isdir(output_file):
+        compressed_bytes = sum(os.path.getsize(os.path.join(root, file))
+                               for root, dirs, files in os.walk(output_file)
+                               for file in files)
+    else:
+        compressed_bytes = os.path.getsize(output_file)
+    compression_stats(stats, codec, dataframe.memory_usage(deep=True).sum(),
+                      compressed_bytes, time.time() - time_start)
+    return output_file
+
+
+def write_output(dataframe, output_file, output_format='csv', codec=None,
+                 level=None, codec_threads=1, stats=None, **kwargs):
+    """Writes the dataframe with one of the OUTPUT_FORMATS.
+
+       codec is one of CODECS (gzip for CSV and the default of parquet if
+       None). partition_cols (eg: PARTITION_COLUMNS) can be given for
+       parquet, output_file is then a directory. Returns the name of the
+       file that was written."""
+    if output_format == 'csv':
+        return write_csv(dataframe, output_file, codec=codec or 'gzip',
+                         level=level, codec_threads=codec_threads,
+                         stats=stats, **kwargs)
+    elif output_format == 'parquet':
+        return write_parquet(dataframe, output_file, codec=codec, level=level,
+                             stats=stats, **kwargs)
+    raise ValueError("Unknown output format '%s', use one of: %s" %
+                     (output_format, ', '.join(OUTPUT_FORMATS)))
+
+
+def read_parquet(input_path, columns_to_keep=None, filters=None):
+    """Returns a DataFrame from a Parquet file or dataset (local or in s3).
+
+       Only columns_to_keep are read. filters are given to pyarrow to skip
+       the data that does not match, as a list of (column, op, value), for
+       example: [('Day', '=', 7), ('Hour', '>=', 8)]."""
+    return pd.read_parquet(input_path.rstrip('/'), engine='pyarrow',
+                           columns=columns_to_keep, filters=filters)
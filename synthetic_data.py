@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+''' A script to make synthetic data to test and benchmark our code locally.
+
+    It makes gzip CDR parts, a cell directory and OD trip files with the
+    same columns as the real ones. The same seed gives the same data.'''
+
+import argparse
+import os
+import sys
+import pandas as pd
+import numpy as np
+
+# Same codes as extract_cells.extract_cell_df
+CCAA_CODES = ['MAD', 'CAT', 'AND', 'ARA', 'AST', 'BAL', 'CAN', 'CTB', 'CLM',
+              'CYL', 'CYM', 'EXT', 'GAL', 'RIO', 'MUR', 'NAV', 'PVA', 'VAL']
+OFFSET_CODES = ['X', 'Y', 'Z']
+TECHNOLOGIES = ['GSM', 'UMTS', 'LTE']
+# Number of CID_X columns of the cell directory
+CID_COLUMNS = 6
+# Bounding box of mainland Spain
+LATITUDES = (36.0, 43.8)
+LONGITUDES = (-9.3, 3.3)
+# Countries of the clients, most of them local
+COUNTRIES = ['Spain', 'France', 'United Kingdom', 'Germany', 'Italy',
+             'Portugal', 'Netherlands', 'United States', 'China', 'Morocco']
+COUNTRY_WEIGHTS = [0.82, 0.04, 0.04, 0.03, 0.02, 0.02, 0.01, 0.01, 0.005,
+                   0.005]
+# Number of zones of the OD matrices (see MatrixGeneratorTemaCG_v3F.py)
+OD_ZONES = 72
+OD_DATES = ['20180507', '20180508', '20180509', '20180510', '20180511',
+            '20180512', '20180513']
+OD_DOMICILES = ['LasPalmas', 'GranCanaria', 'Extranjero', 'Espana']
+OD_REASONS = ['GoWork', 'GoHome', 'GoBoth', 'GoAny']
+# Key used by MatrixGeneratorTemaCG_v3F.py to decrypt the trips
+OD_KEY = 'culo'
+
+
+def make_cell_directory(cells, seed=0):
+    """Returns a cell directory with cells rows.
+
+       Columns are the ones used by extract_cells and kido: Cell_Code,
+       Technology, Region_Code, Municipal_Code, LAC, Latitude, Longitude
+       and CID_1 to CID_X (-1 when empty). LTE cells have Cell_Code with the
+       region, the X/Y/Z offset and the site number."""
+    rng = np.random.RandomState(seed)
+    technology = rng.choice(TECHNOLOGIES, cells, p=[0.3, 0.3, 0.4])
+    lte_mask = technology == 'LTE'
+    region = rng.randint(0, len(CCAA_CODES), cells)
+    site = rng.randint(0, 10000, cells)
+    # str.cat instead of + on the arrays, older numpy can't add strings
+    lte_codes = pd.Series(np.array(CCAA_CODES)[region]).str.cat(
+        [pd.Series(rng.choice(OFFSET_CODES, cells)),
+         pd.Series(site).map('{:04d}'.format),
+         pd.Series(rng.choice(list('ABC'), cells))]).values
+    other_codes = pd.Series(np.arange(cells)).map('C{:07d}'.format).values
+    # Some cells share a position (same mast)
+    masts = max(cells // 3, 1)
+    mast = rng.randint(0, masts, cells)
+    mast_latitude = rng.uniform(LATITUDES[0], LATITUDES[1], masts).round(6)
+    mast_longitude = rng.uniform(LONGITUDES[0], LONGITUDES[1], masts).round(6)
+    cell_df = pd.DataFrame({
+        'Cell_Code': np.where(lte_mask, lte_codes, other_codes),
+        'Technology': technology,
+        'Region_Code': region + 1,
+        'Municipal_Code': (region + 1) * 1000 + rng.randint(1, 300, cells),
+        'LAC': np.where(lte_mask, 0, rng.randint(1, 60000, cells)),
+        'Latitude': mast_latitude[mast],
+        'Longitude': mast_longitude[mast]})
+    # CID go from 1 to 99999 for GSM/UMTS and 0 to 999 for LTE
+    cid = np.where(lte_mask[:, np.newaxis],
+                   rng.randint(0, 1000, (cells, CID_COLUMNS)),
+                   rng.randint(1, 100000, (cells, CID_COLUMNS)))
+    # Fewer cells use the last columns
+    used = rng.randint(1, CID_COLUMNS + 1, cells)
+    cid[np.arange(CID_COLUMNS) >= used[:, np.newaxis]] = -1
+    for i in range(CID_COLUMNS):
+        cell_df['CID_%d' % (i + 1)] = cid[:, i]
+    return cell_df
+
+
+def cell_ids(cell_df):
+    """Returns the Cell ID seen in the CDRs for the cells of cell_df.
+
+       Same as extract_cells: LAC * 100000 + CID for GSM/UMTS and the LAC
+       made from the Cell_Code + CID for LTE."""
+    cid = cell_df.loc[:, 'CID_1':].values
+    lte_mask = (cell_df['Technology'] == 'LTE').values
+    codes = cell_df['Cell_Code'].astype(str)
+    ccaa = codes.str[:3].map({code: i for i, code in enumerate(CCAA_CODES)})
+    offset = codes.str[3].map({code: i for i, code in enumerate(OFFSET_CODES)})
+    site = pd.to_numeric(codes.str[4:8], errors='coerce')
+    lte_lac = ((ccaa * 50000 + offset * 10000 + site) * 1000).fillna(0)
+    lac = np.where(lte_mask, lte_lac.values.astype(np.int64),
+                   cell_df['LAC'].values.astype(np.int64) * 100000)
+    valid = np.where(lte_mask[:, np.newaxis], cid >= 0, cid > 0)
+    return np.unique((cid + lac[:, np.newaxis])[valid])
+
+
+def make_cdr_part(rows, cells, date, rng):
+    """Returns a DataFrame of rows CDRs of one day, using the Cell ID cells.
+
+       A few of the events come from the days before, as in the real data."""
+    year, month, day = int(date[:4]), int(date[4:6]), int(date[6:8])
+    previous = pd.Timestamp(year, month, day) - pd.to_timedelta(
+        rng.choice([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1,
+                    2], rows), unit='D')
+    seconds = rng.randint(0, 86400, rows)
+    return pd.DataFrame({
+        'ID': rng.randint(0, 2 ** 31, rows),
+        'Date': (previous.year * 10000 + previous.month * 100 +
+                 previous.day).values,
+        'Time': (seconds // 3600) * 10000 + (seconds // 60 % 60) * 100 +
+                seconds % 60,
+        'Start Cell': cells[rng.randint(0, len(cells), rows)],
+        'Duration': rng.exponential(90, rows).astype(int),
+        'Country': rng.choice(COUNTRIES, rows, p=COUNTRY_WEIGHTS)})
+
+
+def write_cdr_parts(output_path, rows, parts, cells, date='20180508', seed=0):
+    """Writes rows CDRs split in parts gzip CSV files to output_path.
+
+       Returns the list of files written."""
+    rng = np.random.RandomState(seed)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    file_list = []
+    for part, part_rows in enumerate(np.array_split(np.arange(rows), parts)):
+        file = os.path.join(output_path, 'part-%05d.csv.gz' % part)
+        make_cdr_part(len(part_rows), cells, date, rng).to_csv(
+            file, compression='gzip', index=False)
+        file_list.append(file)
+    return file_list
+
+
+def make_od_trips(rows, seed=0):
+    """Returns a DataFrame of OD trips as read by MatrixGeneratorTemaCG_v3F.
+
+       OD_zonas is a list of [origin, destination, trips] (zone positions)."""
+    rng = np.random.RandomState(seed)
+    legs = rng.randint(0, 4, rows)
+    origin = rng.randint(0, OD_ZONES, legs.sum())
+    destination = rng.randint(0, OD_ZONES, legs.sum())
+    trips = rng.randint(1, 4, legs.sum())
+    leg_strings = ['[%d, %d, %d]' % leg
+                   for leg in zip(origin, destination, trips)]
+    bounds = np.concatenate([[0], np.cumsum(legs)])
+    od_zonas = ['[' + ', '.join(leg_strings[bounds[i]:bounds[i + 1]]) + ']'
+                for i in range(rows)]
+    hours = rng.randint(0, 24, rows)
+    return pd.DataFrame({
+        'Domicilio': rng.choice(OD_DOMICILES, rows),
+        'ID_EDAD': rng.randint(0, 100, rows),
+        'Reason': rng.choice(OD_REASONS, rows),
+        'TimeO': hours * 10000 + rng.randint(0, 60, rows) * 100,
+        'W': rng.uniform(1, 50, rows).round(3),
+        'OD_zonas': od_zonas})
+
+
+def write_od_trips(output_path, rows, dates=OD_DATES, seed=0, encrypt=True):
+    """Writes one OD trip file per date to output_path/data.
+
+       The files MatrixGeneratorTemaCG_v3F.py reads are encrypted with
+       simplecrypt, they are only made if it is installed (and encrypt).
+       A plain CSV is always written next to them. Also writes an
+       input_parameters.csv for an average day. Returns the files written."""
+    data_path = os.path.join(output_path, 'data')
+    for path in [data_path, os.path.join(output_path, 'matrices')]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+    if encrypt:
+        try:
+            from simplecrypt import encrypt as simple_encrypt
+        except ImportError:
+            print("simplecrypt is not installed, only plain OD files are made.")
+            encrypt = False
+    file_list = []
+    for i, date in enumerate(dates):
+        name = os.path.join(data_path, 'ODzonas_trips_r-35_%s.csv' % date)
+        trips = make_od_trips(rows, seed + i).to_csv(sep=';', index=False)
+        with open(name, 'w') as output:
+            output.write(trips)
+        file_list.append(name)
+        if encrypt:
+            with open(name + '.enc', 'wb') as output:
+                output.write(simple_encrypt(OD_KEY, trips.encode('latin')))
+            file_list.append(name + '.enc')
+    parameters = [('dia', 'media'), ('domicilio', 'Todos'),
+                  ('edades', '[0,100]'), ('motivo', 'Todos'),
+                  ('horas', '[0,24]'), ('NombreFiltro', 'synthetic')]
+    pd.DataFrame(parameters).to_csv(os.path.join(output_path,
+                                                 'input_parameters.csv'),
+                                    header=False, index=False)
+    return file_list
+
+
+def make_dataset(output_path, rows, parts=8, cells=None, od_rows=None,
+                 seed=0, encrypt=True):
+    """Writes a full synthetic dataset to output_path and returns its paths.
+
+       By default the cell directory has a cell for every 20 CDRs (at least
+       1000) and there is an OD trip for every 10 CDRs."""
+    if cells is None:
+        cells = max(rows // 20, 1000)
+    if od_rows is None:
+        od_rows = max(rows // 10, 100)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    cell_df = make_cell_directory(cells, seed)
+    cell_file = os.path.join(output_path, 'cells_all_synthetic.csv.gz')
+    cell_df.to_csv(cell_file, compression='gzip', index=False)
+    cdr_path = os.path.join(output_path, 'cdr')
+    cdr_files = write_cdr_parts(cdr_path, rows, parts, cell_ids(cell_df),
+                                seed=seed)
+    od_path = os.path.join(output_path, 'od')
+    od_files = write_od_trips(od_path, od_rows, seed=seed, encrypt=encrypt)
+    return {'cell_file': cell_file, 'cdr_path': cdr_path,
+            'cdr_files': cdr_files, 'od_path': od_path, 'od_files': od_files,
+            'rows': rows, 'cells': cells, 'od_rows': od_rows}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", type=str, help="Directory to write the data to")
+    parser.add_argument("rows", type=int, help="Number of CDRs to make")
+    parser.add_argument("-p", "--parts", default=8, type=int,
+                        help="Number of files the CDRs are split in")
+    parser.add_argument("-c", "--cells", type=int,
+                        help="Number of cells in the directory (default: rows / 20)")
+    parser.add_argument("--od_rows", type=int,
+                        help="Number of OD trips per day (default: rows / 10)")
+    parser.add_argument("--seed", default=0, type=int, help="Random seed")
+    args = parser.parse_args()
+
+    dataset = make_dataset(args.output, args.rows, args.parts, args.cells,
+                           args.od_rows, args.seed)
+    print("Made %d CDRs in %d files, %d cells and %d OD trips per day in %s" %
+          (dataset['rows'], len(dataset['cdr_files']), dataset['cells'],
+           dataset['od_rows'], args.output))
+
+    sys.exit()
@@ -0,0 +1,51 @@
+''' Cache of the zone of every cell.'''
+
+import os
+
+import pandas as pd
+import pytest
+
+import kido
+import synthetic_data
+
+geopandas = pytest.importorskip('geopandas')
+shapely_geometry = pytest.importorskip('shapely.geometry')
+
+
+@pytest.fixture
+def cell_file(tmp_path):
+    file = os.path.join(str(tmp_path), 'cells.csv.gz')
+    synthetic_data.make_cell_directory(300, seed=2).to_csv(file, index=False)
+    return file
+
+
+def make_areas(ids):
+    """Two halves of the map, in longitude."""
+    west, east = synthetic_data.LONGITUDES
+    middle = (west + east) / 2
+    south, north = synthetic_data.LATITUDES
+    return geopandas.GeoDataFrame(
+        {'id': ids},
+        geometry=[shapely_geometry.box(west, south, middle, north),
+                  shapely_geometry.box(middle, south, east + 1, north)])
+
+
+@pytest.mark.parametrize('ids', [[1, 2], ['28079', '08019']])
+def test_cold_and_warm(cell_file, tmp_path, ids):
+    cache_dir = os.path.join(str(tmp_path), 'cache')
+    cold_df = kido.cell_zone_lookup(cell_file, make_areas(ids), cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    warm_df = kido.cell_zone_lookup(cell_file, make_areas(ids), cache_dir)
+    pd.testing.assert_frame_equal(cold_df, warm_df)
+    assert list(cold_df.columns) == ['Cell ID', 'Municipal_Code',
+                                     'Region_Code', 'Zone']
+    assert set(cold_df['Zone']) <= set(ids)
+    assert (cold_df['Municipal_Code'] // 1000 == cold_df['Region_Code']).all()
+
+
+def test_new_areas(cell_file, tmp_path):
+    cache_dir = os.path.join(str(tmp_path), 'cache')
+    kido.cell_zone_lookup(cell_file, make_areas([1, 2]), cache_dir)
+    zone_df = kido.cell_zone_lookup(cell_file, make_areas([3, 4]), cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+    assert set(zone_df['Zone']) <= {3, 4}
@@ -0,0 +1,47 @@
+''' Year, Month, Day and Hour made from the Date and Time of the CDRs.'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import kido
+
+
+def test_date_columns():
+    cdr_df = pd.DataFrame({'Date': [20180508, 20160229],
+                           'Time': [235959, 102030]})
+    kido.makeDateTimeColumns(cdr_df, datetime_column='Datetime')
+    assert cdr_df['Year'].dtype == np.uint16
+    assert cdr_df['Hour'].dtype == np.uint8
+    assert cdr_df['Year'].tolist() == [2018, 2016]
+    assert cdr_df['Month'].tolist() == [5, 2]
+    assert cdr_df['Day'].tolist() == [8, 29]
+    assert cdr_df['Hour'].tolist() == [23, 10]
+    assert cdr_df['Datetime'].tolist() == [pd.Timestamp('2018-05-08 23:59:59'),
+                                           pd.Timestamp('2016-02-29 10:20:30')]
+
+
+def test_missing_timestamp():
+    cdr_df = pd.DataFrame({'Date': [20180508, np.nan, 20180507],
+                           'Time': [235959, 120000, np.nan]})
+    kido.makeDateTimeColumns(cdr_df, datetime_column='Datetime')
+    assert cdr_df['Year'].dtype == 'UInt16'
+    assert cdr_df['Day'].dtype == 'UInt8'
+    assert cdr_df['Hour'].dtype == 'UInt8'
+    assert cdr_df['Year'].isnull().tolist() == [False, True, False]
+    assert cdr_df['Day'].tolist()[2] == 7
+    assert cdr_df['Hour'].isnull().tolist() == [False, False, True]
+    assert cdr_df['Hour'].tolist()[1] == 12
+    assert cdr_df['Datetime'].isnull().tolist() == [False, True, True]
+
+
+def test_missing_date_partition(tmp_path):
+    cdr_df = pd.DataFrame({'Date': [20180508, np.nan], 'Time': [0, 0],
+                           'Start Cell': [1, 2]})
+    output_file = os.path.join(str(tmp_path), 'cdrs')
+    kido.write_parquet(cdr_df, output_file,
+                       partition_cols=kido.PARTITION_COLUMNS)
+    assert os.path.isdir(os.path.join(output_file, 'Year=0', 'Month=0', 'Day=0'))
+    parquet_df = kido.read_parquet(output_file).sort_values('Start Cell')
+    assert parquet_df['Day'].astype(int).tolist() == [8, kido.NO_DAY]
@@ -0,0 +1,54 @@
+''' Splitting CDRs by day and the DayRouter buffers.'''
+
+import numpy as np
+import pandas as pd
+
+import kido
+
+
+def make_cdr_df(dates):
+    return pd.DataFrame({'Date': dates, 'Time': np.arange(len(dates))})
+
+
+def test_split_by_day_keeps_missing_dates():
+    cdr_df = make_cdr_df([20180508, np.nan, 20180507, 20180508, np.nan])
+    parts = kido.split_by_day(cdr_df)
+    assert sorted(parts) == [kido.NO_DAY, 20180507, 20180508]
+    assert list(parts[kido.NO_DAY]['Time']) == [1, 4]
+    assert list(parts[20180508]['Time']) == [0, 3]
+    assert sum(len(part) for part in parts.values()) == len(cdr_df)
+
+
+def test_router_writes_every_row():
+    spilled = []
+
+    def spill(day, dataframe, keys, done_keys):
+        spilled.append((day, len(dataframe), keys, done_keys))
+
+    router = kido.DayRouter(spill, max_rows=3)
+    router.add('a', make_cdr_df([20180508, 20180507, np.nan]))
+    router.add('b', make_cdr_df([20180508, 20180508]))
+    router.add('c', make_cdr_df([]))
+    router.flush()
+    # 20180508 is full with the rows of b, c has no data
+    assert spilled[0] == (20180508, 3, ['a', 'b'], ['b'])
+    assert spilled[1] == (None, 0, ['c'], ['c'])
+    assert sorted(spilled[2:]) == [(kido.NO_DAY, 1, ['a'], []),
+                                   (20180507, 1, ['a'], ['a'])]
+    assert sum(rows for day, rows, keys, done_keys in spilled) == 5
+
+
+def test_router_days_split_before():
+    spilled = []
+
+    def spill(day, dataframe, keys, done_keys):
+        spilled.append((day, list(dataframe.get('Time', [])), keys, done_keys))
+
+    router = kido.DayRouter(spill, max_rows=10)
+    router.add_days('a', kido.split_by_day(make_cdr_df([20180508, 20180507])))
+    router.add('b', make_cdr_df([20180507]))
+    router.add_days('c', {})
+    router.flush()
+    assert spilled == [(None, [], ['c'], ['c']),
+                       (20180507, [1, 0], ['a', 'b'], ['b']),
+                       (20180508, [0], ['a'], ['a'])]
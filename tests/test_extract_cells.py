@@ -0,0 +1,98 @@
+''' extract_cell_df against the row by row code it replaced.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import extract_cells
+import synthetic_data
+
+
+def old_make_zone_df(cell_dataframe, zone_data, column_data, full):
+    zone_df = pd.DataFrame()
+    if full:
+        zone_df = cell_dataframe
+    else:
+        for i in range(len(zone_data)):
+            for zone in zone_data[i]:
+                local_df = extract_cells.extract_zone(cell_dataframe,
+                                                      column_data[i], int(zone))
+                zone_df = pd.concat([zone_df, local_df])
+    return zone_df
+
+
+def old_extract_cell_df(cell_dataframe, municipalities=None, regions=None):
+    """extract_cell_df before it was vectorized (append is now concat)."""
+    name_string, zone_data, column_data, full = extract_cells.expand_arguments(
+        municipalities, regions)
+    zone_df = old_make_zone_df(cell_dataframe, zone_data, column_data, full)
+    zone_df = zone_df.reindex(columns=list(zone_df.columns[zone_df.apply(np.max) != -1]))
+    zone_df.drop(zone_df.index[zone_df.loc[:, 'CID_1':].apply(max, axis=1) < 0], inplace=True)
+    zone_df.reset_index(drop=True, inplace=True)
+    lte_mask = zone_df.Technology.str.contains('LTE')
+    lte_zone_df = zone_df[lte_mask].copy()
+    zone_df = zone_df[~lte_mask].copy()
+    front = zone_df.loc[:, :'Longitude']
+    column_mask = zone_df.columns.str.contains('CID')
+    updated_cid = zone_df.loc[:, zone_df.columns[column_mask]].add(zone_df.LAC * 100000, axis=0)
+    zone_df = pd.concat([front, updated_cid], axis=1)
+    reset_mask = (zone_df.loc[:, column_mask].T > zone_df.LAC * 100000).T
+    zone_cid = zone_df.loc[:, column_mask][reset_mask].apply(pd.to_numeric).fillna(-1).astype(int)
+    zone_df = pd.concat([front, zone_cid], axis=1)
+    ccaa_codes = {'MAD': 0, 'CAT': 1, 'AND': 2, 'ARA': 3, 'AST': 4, 'BAL': 5,
+                  'CAN': 6, 'CTB': 7, 'CLM': 8, 'CYL': 9, 'CYM': 10, 'EXT': 11,
+                  'GAL': 12, 'RIO': 13, 'MUR': 14, 'NAV': 15, 'PVA': 16,
+                  'VAL': 17}
+    offset_codes = {'X': 0, 'Y': 1, 'Z': 2}
+    lte_zone_df['LAC'] = lte_zone_df.apply(lambda row: ccaa_codes[row['Cell_Code'][:3]] * 50000, axis=1)
+    lte_zone_df['LAC'] += lte_zone_df.apply(lambda row: offset_codes[row['Cell_Code'][3]] * 10000, axis=1)
+    lte_zone_df['LAC'] += lte_zone_df.apply(lambda row: int(row['Cell_Code'][4:8]), axis=1)
+    lte_zone_df['LAC'] *= 1000
+    front = lte_zone_df.loc[:, :'Longitude']
+    column_mask = lte_zone_df.columns.str.contains('CID')
+    updated_cid = lte_zone_df.loc[:, lte_zone_df.columns[column_mask]].add(lte_zone_df.LAC, axis=0)
+    lte_zone_df = pd.concat([front, updated_cid], axis=1)
+    reset_mask = (lte_zone_df.loc[:, column_mask].T >= lte_zone_df.LAC).T
+    zone_cid = lte_zone_df.loc[:, column_mask][reset_mask].apply(pd.to_numeric).fillna(-1).astype(int)
+    lte_zone_df = pd.concat([front, zone_cid], axis=1)
+    zone_df = pd.concat([zone_df, lte_zone_df])
+    return [name_string, zone_df]
+
+
+@pytest.fixture(scope='module')
+def cell_df():
+    cell_df = synthetic_data.make_cell_directory(3000, seed=1)
+    # An empty CID column and rows without any CID
+    cell_df['CID_6'] = -1
+    cell_df.loc[:20, 'CID_1':] = -1
+    return cell_df
+
+
+def some_codes(cell_df, column, count):
+    """Returns a string with the most common codes of column."""
+    codes = cell_df[column].value_counts().index[:count]
+    return ','.join(str(code) for code in sorted(codes))
+
+
+@pytest.mark.parametrize('municipality_count,region_count', [
+    (0, 0), (4, 0), (0, 3), (2, 2)])
+def test_same_output_as_old_code(cell_df, municipality_count, region_count):
+    municipalities = regions = None
+    if municipality_count:
+        municipalities = some_codes(cell_df, 'Municipal_Code',
+                                    municipality_count)
+    if region_count:
+        regions = some_codes(cell_df, 'Region_Code', region_count)
+    old_name, old_df = old_extract_cell_df(cell_df, municipalities, regions)
+    name, zone_df = extract_cells.extract_cell_df(cell_df, municipalities,
+                                                  regions)
+    assert name == old_name
+    assert zone_df.to_csv(index=False) == old_df.to_csv(index=False)
+
+
+def test_unknown_lte_code(cell_df):
+    cell_df = cell_df.copy()
+    lte = cell_df.index[cell_df['Technology'] == 'LTE'][30]
+    cell_df.loc[lte, 'Cell_Code'] = 'XXXX0001A'
+    with pytest.raises(KeyError):
+        extract_cells.extract_cell_df(cell_df)
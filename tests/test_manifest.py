@@ -0,0 +1,89 @@
+''' The work manifest with several days staged side by side.'''
+
+import os
+
+import pytest
+
+import kido
+
+
+def stage_file(staging_dir, name):
+    path = os.path.join(kido.make_safe_dir(staging_dir), name)
+    with open(path, 'w') as output:
+        output.write(name)
+    return path
+
+
+@pytest.fixture
+def two_days(tmp_path, monkeypatch):
+    """Two manifests (days) sharing the same staging directory."""
+    monkeypatch.chdir(str(tmp_path))
+    days = []
+    for day in ['20180507', '20180508']:
+        manifest_file = 'manifest_%s.sqlite' % day
+        manifest = kido.open_manifest(manifest_file)
+        staging_dir = kido.manifest_staging_dir('_staging', manifest_file)
+        kido.register_inputs(manifest, [('input_%s' % day, 'etag', 1)])
+        days.append((manifest, staging_dir, day))
+    return days
+
+
+def test_staging_dir_per_manifest():
+    assert (kido.manifest_staging_dir('_staging', 'a/manifest_20180508.sqlite')
+            == os.path.join('_staging', 'manifest_20180508'))
+    assert (kido.manifest_staging_dir('_staging', 'manifest_20180507.sqlite') !=
+            kido.manifest_staging_dir('_staging', 'manifest_20180508.sqlite'))
+
+
+def test_discard_keeps_other_manifests(two_days):
+    (manifest_a, staging_a, day_a), (manifest_b, staging_b, day_b) = two_days
+    # Day A crashed after recording its output but before publishing it
+    staged_a = stage_file(staging_a, 'output_a.csv.gz')
+    kido.record_outputs(manifest_a, ['input_%s' % day_a],
+                        [(staged_a, os.path.join('CDRs', day_a, 'output_a.csv.gz'))])
+    # Day B crashed before recording its output
+    staged_b = stage_file(staging_b, 'output_b.csv.gz')
+
+    kido.discard_unrecorded(manifest_b, staging_b)
+    assert not os.path.exists(staged_b)
+    assert os.path.exists(staged_a)
+
+    assert kido.publish_outputs(manifest_a) == 1
+    assert os.path.exists(os.path.join('CDRs', day_a, 'output_a.csv.gz'))
+    assert kido.publish_outputs(manifest_b) is None
+
+
+def test_discard_unfinished_inputs(two_days):
+    (manifest_a, staging_a, day_a), (manifest_b, staging_b, day_b) = two_days
+    kido.register_inputs(manifest_a, [('other_input', 'etag', 1)])
+    # An output with two inputs, only one of them done when it crashed
+    staged = stage_file(staging_a, 'output_a.csv.gz')
+    kido.record_outputs(manifest_a, ['input_%s' % day_a, 'other_input'],
+                        [(staged, 'output_a.csv.gz')], ['input_%s' % day_a])
+    staged_b = stage_file(staging_b, 'output_b.csv.gz')
+    kido.record_outputs(manifest_b, ['input_%s' % day_b],
+                        [(staged_b, 'output_b.csv.gz')])
+
+    kido.discard_unrecorded(manifest_a, staging_a)
+    assert not os.path.exists(staged)
+    assert os.path.exists(staged_b)
+    assert sorted(kido.pending_inputs(manifest_a)) == ['input_%s' % day_a,
+                                                       'other_input']
+    assert kido.publish_outputs(manifest_b) == 1
+
+
+def test_discard_keeps_parquet_datasets(two_days):
+    (manifest_a, staging_a, day_a), _ = two_days
+    staged = os.path.join(staging_a, 'output_a.parquet')
+    dataset_file = stage_file(os.path.join(staged, 'Year=2018', 'Month=5',
+                                           'Day=7'), 'part-0.parquet')
+    kido.record_outputs(manifest_a, ['input_%s' % day_a],
+                        [(staged, os.path.join('CDRs', 'output_a.parquet'))])
+    unrecorded = stage_file(staging_a, 'output_b.parquet')
+
+    kido.discard_unrecorded(manifest_a, staging_a)
+    assert os.path.exists(dataset_file)
+    assert not os.path.exists(unrecorded)
+    assert kido.publish_outputs(manifest_a) == 1
+    assert os.path.exists(os.path.join('CDRs', 'output_a.parquet', 'Year=2018',
+                                       'Month=5', 'Day=7', 'part-0.parquet'))
@@ -0,0 +1,98 @@
+''' S3Upload and stream_to_s3 against a mocked s3 (moto).'''
+
+import gzip
+import io
+
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+
+moto = pytest.importorskip('moto')
+
+import kido
+
+BUCKET = 'kido-test'
+MB = 1024 ** 2
+
+
+@pytest.fixture
+def client(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'),
+                        ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def read_object(client, key):
+    return client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+
+def test_small_upload(client):
+    with kido.S3Upload(BUCKET, 'small', client=client) as upload:
+        upload.write(b'hello ')
+        upload.write(b'world')
+    assert upload.upload_id is None
+    assert read_object(client, 'small') == b'hello world'
+
+
+def test_multipart_upload(client):
+    data = np.random.RandomState(0).bytes(12 * MB + 123)
+    with kido.S3Upload(BUCKET, 'big', part_size=5 * MB, threads=2,
+                       client=client) as upload:
+        # Writes that don't match the parts
+        for start in range(0, len(data), 3 * MB):
+            upload.write(data[start:start + 3 * MB])
+    assert upload.upload_id is not None
+    assert len(upload.parts) == 3
+    assert upload.tell() == len(data)
+    assert read_object(client, 'big') == data
+
+
+def test_abort_leaves_nothing(client):
+    with pytest.raises(RuntimeError):
+        with kido.S3Upload(BUCKET, 'aborted', part_size=5 * MB,
+                           client=client) as upload:
+            upload.write(b'x' * 11 * MB)
+            raise RuntimeError('failed while writing')
+    assert upload.upload_id is not None
+    assert 'Contents' not in client.list_objects_v2(Bucket=BUCKET)
+    assert not client.list_multipart_uploads(Bucket=BUCKET).get('Uploads')
+
+
+def test_failed_part_is_sent_again(client, monkeypatch):
+    monkeypatch.setattr(kido.time, 'sleep', lambda seconds: None)
+    failures = []
+    upload_part = client.upload_part
+
+    def flaky_upload_part(**kwargs):
+        if not failures:
+            failures.append(kwargs['PartNumber'])
+            raise IOError('connection reset')
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(client, 'upload_part', flaky_upload_part)
+    data = b'y' * (6 * MB)
+    with kido.S3Upload(BUCKET, 'retried', part_size=5 * MB, retries=1,
+                       client=client) as upload:
+        upload.write(data)
+    assert failures == [1]
+    assert read_object(client, 'retried') == data
+
+
+def test_stream_to_s3(client):
+    cdr_df = pd.DataFrame({'Date': [20180508] * 1000, 'Time': np.arange(1000),
+                           'Country': ['Spain', 'France'] * 500})
+    stats = {}
+    path = kido.stream_to_s3(cdr_df, BUCKET, 'CDRs/output.csv.gz',
+                             client=client, stats=stats)
+    assert path == 's3://%s/CDRs/output.csv.gz' % BUCKET
+    body = read_object(client, 'CDRs/output.csv.gz')
+    assert stats['bytes'] == len(body)
+    assert gzip.decompress(body) == cdr_df.to_csv(index=False).encode()
+    back_df = pd.read_csv(io.BytesIO(body), compression='gzip')
+    assert back_df.equals(cdr_df)
@@ -0,0 +1,82 @@
+''' CDR_SCHEMA applied to frames read in pieces.'''
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import kido
+
+
+@pytest.fixture
+def cdr_files(tmp_path):
+    """Two CDR files with different countries."""
+    files = []
+    for i, countries in enumerate([['Spain', 'France', 'Spain'],
+                                   ['Italy', 'Italy', 'Spain']]):
+        cdr_df = pd.DataFrame({'Date': [20180508] * 3,
+                               'Start Cell': [3 * i + 1, 3 * i + 2, 3 * i + 3],
+                               'Country': countries,
+                               'Latitude': [40.1, 40.2, 40.3]})
+        file = os.path.join(str(tmp_path), 'part-%d.csv.gz' % i)
+        cdr_df.to_csv(file, index=False)
+        files.append(file)
+    return files
+
+
+def test_apply_schema_copies():
+    cdr_df = pd.DataFrame({'Date': [20180508, 20180509], 'Time': [0, 235959]})
+    schema_df = kido.apply_schema(cdr_df)
+    assert cdr_df['Date'].dtype == np.int64
+    assert schema_df['Date'].dtype == np.uint32
+    assert schema_df['Time'].dtype == np.uint32
+
+
+def test_same_types_for_every_chunk(cdr_files):
+    chunks = list(kido.iter_csv_chunks(cdr_files, chunk_rows=2,
+                                       schema=kido.CDR_SCHEMA))
+    assert len(chunks) == 3
+    for chunk in chunks:
+        assert chunk['Date'].dtype == np.uint32
+        assert chunk['Start Cell'].dtype == np.int64
+        assert chunk['Latitude'].dtype == np.float32
+        assert chunk['Country'].dtype.name == 'category'
+    cdr_df = kido.concat_frames(chunks)
+    assert cdr_df['Start Cell'].dtype == np.int64
+    assert cdr_df['Country'].dtype.name == 'category'
+    assert list(cdr_df['Country']) == ['Spain', 'France', 'Spain',
+                                       'Italy', 'Italy', 'Spain']
+
+
+def test_same_types_for_every_file(cdr_files):
+    cdr_df = kido.readAllCSVInPath(os.path.dirname(cdr_files[0]),
+                                   schema=kido.CDR_SCHEMA)
+    assert cdr_df['Start Cell'].dtype == np.int64
+    assert cdr_df['Country'].dtype.name == 'category'
+    assert len(cdr_df) == 6
+
+
+def test_fixed_schema_does_not_fit():
+    cdr_df = pd.DataFrame({'Start Cell': [1.5, np.nan]})
+    assert kido.apply_schema(cdr_df)['Start Cell'].dtype == np.float64
+    with pytest.raises(ValueError):
+        kido.apply_schema(cdr_df, fixed=True)
+
+
+def test_fixed_schema_real_cells(tmp_path):
+    # GSM cells are LAC * 100000 + CID, the second row has no cell
+    cdr_df = pd.DataFrame({'Date': [20180508, 20180508, 20180508],
+                           'Start Cell': [65535 * 100000 + 99999, np.nan,
+                                          28000 * 100000 + 12]})
+    file = os.path.join(str(tmp_path), 'part-0.csv.gz')
+    cdr_df.to_csv(file, index=False)
+    chunks = list(kido.iter_csv_chunks([file], chunk_rows=2,
+                                       schema=kido.CDR_SCHEMA))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert kido.concat_frames(chunks)['Start Cell'].dtype == 'Int64'
+    cdr_df = kido.readAllCSVInPath(str(tmp_path), schema=kido.CDR_SCHEMA)
+    assert cdr_df['Start Cell'].dtype == 'Int64'
+    assert cdr_df['Start Cell'].isnull().tolist() == [False, True, False]
+    assert cdr_df['Start Cell'][0] == 6553599999
+    assert cdr_df['Date'].dtype == np.uint32